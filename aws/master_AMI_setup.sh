@@ -31,7 +31,7 @@
 #
 #    !!!! need to add log rotation /etc/logrotate.conf
 #
-#/var/log/piped.log {
+#/var/log/qcbroker.log {
 #   missingok
 #   create 644 root root
 #   size 100k
@@ -121,7 +121,8 @@ plumb_pipes()
 { 
    sudo mkdir -p /scratch
    sudo mkdir -p $prefix/qcloud/redis
-   sudo systemctl enable $prefix/qcloud/services/piped.service
+   sudo mkdir -p $prefix/qcloud/run
+   sudo systemctl enable $prefix/qcloud/services/qcbroker.service
    sudo systemctl enable $prefix/qcloud/services/QCloud.service
 }
 
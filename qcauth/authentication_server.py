@@ -1,19 +1,23 @@
 import os
-import jwt
 import sys
 import ssl
+import math
+import time
+import uuid
 import string
 import base64
 import random
 import logging
-import datetime
 import configparser
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 
+import qctoken
 import user_manager
+from token_revocations import RevocationList, revoke
+from rate_limit import RateLimiter
 
 
 
@@ -39,28 +43,43 @@ def random_key():
 
 
 
-def generate_jwt(userid, exp, code):
+def generate_jwt(userid, exp, keyring, jti):
     payload = {}
     payload['userid'] = userid
+    payload['jti'] = jti
 
     if (userid == 1):  
-       payload['exp'] =  datetime.datetime.utcnow() 
-       payload['exp'] += datetime.timedelta(seconds=1)
+       payload['exp'] = int(time.time()) + 1
     elif (exp != 0):
-       payload['exp'] =  datetime.datetime.utcnow() 
-       payload['exp'] += datetime.timedelta(seconds=int(exp))
+       payload['exp'] = int(time.time()) + int(exp)
 
-    token = jwt.encode(payload, code, algorithm='HS256')
-
-    return token.decode('utf-8')
+    return qctoken.encode(payload, keyring)
 
 
 
 class BaseHandler(tornado.web.RequestHandler):
-    def initialize(self, jwt_code, jwt_expiry, user_manager):
-        self.jwt_code     = jwt_code
+    def initialize(self, jwt_keyring, jwt_expiry, user_manager, revocations, rate_limiter):
+        self.jwt_keyring  = jwt_keyring
         self.jwt_expiry   = jwt_expiry
         self.user_manager = user_manager
+        self.revocations  = revocations
+        self.rate_limiter = rate_limiter
+
+    def check_rate(self, name, ident):
+        """Refuses the request with a 429 if ident is over the named limit"""
+        wait = self.rate_limiter.check(name, ident)
+        if (wait > 0):
+           self.set_status(429)
+           self.set_header("Retry-After", int(math.ceil(wait)))
+           raise Exception("Too many requests, retry after %d seconds" % math.ceil(wait))
+
+    def issue_token(self, user, userid, exp):
+        """Returns a new access token, recorded under the user so that it
+        can be revoked"""
+        jti   = uuid.uuid4().hex
+        token = generate_jwt(userid, exp, self.jwt_keyring, jti)
+        self.user_manager.add_token(jti, qctoken.expiry(token), user)
+        return token
 
     def dump_headers(self):
         hdrs = self.request.headers 
@@ -70,17 +89,20 @@ class BaseHandler(tornado.web.RequestHandler):
 
 
 class AddUser(BaseHandler):
-    def get(self):
+    async def get(self):
         try:
+            self.check_rate("token_ip", self.rate_limiter.client_address(self.request))
             user   = self.request.headers["Qcloud-Client-User"]
             passwd = self.request.headers["Qcloud-Client-Password"]
             auth   = self.request.headers["Qcloud-Client-Authorisation"]
-            userid = self.user_manager.add_user(user, passwd, auth)
-            token  = generate_jwt(userid, self.jwt_expiry, self.jwt_code)
+            userid = await self.user_manager.add_user(user, passwd, auth)
+            token  = self.issue_token(user, userid, self.jwt_expiry)
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Userid", userid) 
             self.set_header("Qcloud-Token", token)
+            self.set_header("Qcloud-Refresh-Token",
+               self.user_manager.add_refresh_token(user, userid))
             logging.info("User added: " + user)
 
         except KeyError as e:
@@ -97,8 +119,9 @@ class AddUser(BaseHandler):
 class AddAnonymousUser(BaseHandler):
     def get(self):
         try:
+            self.check_rate("register_ip", self.rate_limiter.client_address(self.request))
             userid = self.user_manager.add_anonymous_user()
-            token  = generate_jwt(userid, 0, self.jwt_code)
+            token  = self.issue_token(userid, userid, 0)
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Userid", userid) 
@@ -113,11 +136,12 @@ class AddAnonymousUser(BaseHandler):
 
 
 class DeleteUser(BaseHandler):
-    def get(self):
+    async def get(self):
         try:
+            self.check_rate("token_ip", self.rate_limiter.client_address(self.request))
             user   = self.request.headers["Qcloud-Client-User"]
             auth   = self.request.headers["Qcloud-Client-Authorisation"]
-            userid = self.user_manager.delete_user(user, auth)
+            userid = await self.user_manager.delete_user(user, auth)
 
             self.set_header("Qcloud-Server-Status", "OK")
             logging.info('User deleted: ' + user)
@@ -134,21 +158,85 @@ class DeleteUser(BaseHandler):
 
 
 class RequestToken(BaseHandler):
-    def get(self):
+    async def get(self):
         try:
+            self.check_rate("token_ip", self.rate_limiter.client_address(self.request))
             user   = self.request.headers["Qcloud-Client-User"]
             passwd = self.request.headers["Qcloud-Client-Password"]
+            self.check_rate("token_user", user)
 
-            if (not self.user_manager.authenticate_user(user, passwd)):
+            # The password is checked in the hashing pool while other
+            # requests are served
+            if (not await self.user_manager.authenticate_user(user, passwd)):
                raise Exception("Invalid password")
 
-            userid = str(self.user_manager.rdb.hget(user,'id'))
-            token  = generate_jwt(userid, self.jwt_expiry, self.jwt_code)
+            userid = str(self.user_manager.rdb.hget("user:"+user,'id'))
+            token  = self.issue_token(user, userid, self.jwt_expiry)
+
+            self.set_header("Qcloud-Server-Status", "OK")
+            self.set_header("Qcloud-Server-Userid", userid) 
+            self.set_header("Qcloud-Token", token) 
+            if (user != self.user_manager.admin and not self.user_manager.anon):
+               self.set_header("Qcloud-Refresh-Token",
+                  self.user_manager.add_refresh_token(user, userid))
+            logging.info("Token issued for user " + user)
+
+        except KeyError as e:
+            msg = "Missing header: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+
+
+
+class RefreshToken(BaseHandler):
+    """Issues a new access token for a refresh token, which saves checking
+    the password again"""
+    def get(self):
+        try:
+            self.check_rate("token_ip", self.rate_limiter.client_address(self.request))
+            refresh = self.request.headers["Qcloud-Refresh-Token"]
+            (user, userid) = self.user_manager.use_refresh_token(refresh)
+            token  = self.issue_token(user, userid, self.jwt_expiry)
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Userid", userid) 
             self.set_header("Qcloud-Token", token) 
-            logging.info("Token issued for user " + user + ":" + token)
+            logging.info("Token refreshed for user " + user)
+
+        except KeyError as e:
+            msg = "Missing header: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+
+
+
+class RevokeToken(BaseHandler):
+    """Revokes the access token and refresh token passed, either may be
+    left out"""
+    def get(self):
+        try:
+            token   = self.request.headers.get("Qcloud-Token")
+            refresh = self.request.headers.get("Qcloud-Refresh-Token")
+            if (token is None and refresh is None):
+               raise KeyError("Qcloud-Token")
+
+            if (refresh is not None):
+               self.user_manager.revoke_refresh_token(refresh)
+            if (token is not None):
+               claims = qctoken.decode(token, self.jwt_keyring)
+               if ('jti' in claims):
+                  with self.user_manager.rdb.pipeline() as p:
+                      revoke(p, claims['jti'], claims.get('exp'))
+                      p.execute()
+            self.set_header("Qcloud-Server-Status", "OK")
 
         except KeyError as e:
             msg = "Missing header: " + str(e)
@@ -165,27 +253,16 @@ class ValidateToken(BaseHandler):
     def get(self):
         try: 
             token = self.request.headers["Qcloud-Token"]
-            logging.info("validating token: " + token)
-            logging.info("    with key:     " + self.jwt_code)
-            decoded = jwt.decode(token, self.jwt_code, algorithm='HS256')
+            decoded = qctoken.decode(token, self.jwt_keyring)
+            if (self.revocations.is_revoked(decoded.get('jti'))):
+               raise qctoken.TokenError("JWT revoked token")
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Userid", decoded['userid'])
-            logging.info("    user decoded: " + decoded['userid'])
 
-        except jwt.ExpiredSignatureError:
-            msg = "JWT signature expired"
+        except qctoken.TokenError as e:
+            msg = str(e)
             self.set_header("Qcloud-Server-Message", msg)
             logging.info(msg)
-   
-        except jwt.DecodeError:
-            msg = "JWT failed validation"
-            self.set_header("Qcloud-Server-Message", msg)
-            logging.error(msg)
-
-        except jwt.InvalidTokenError:
-            msg = "JWT invalid token"
-            self.set_header("Qcloud-Server-Message", msg)
-            logging.error(msg)
 
         except KeyError as e:
             msg = "Missing header: " + str(e)
@@ -205,24 +282,36 @@ class AuthenticationServer(tornado.web.Application):
 		# A random key generated here will invalidate all previously issued
 		# JWTs.  This should NOT be a random key if the server is anonymous as
 		# existing users will no longer be able to validate their tokens.
-        jwt_code   = config.get("authentication", "jwt_code")
-        jwt_expiry = config.get("authentication", "jwt_expiry")
+		# Keys are rotated by adding the new key to [jwt_keys] and making it
+		# active with jwt_kid.  Tokens signed with the old key stay valid
+		# until it is removed, once they have expired.
+        jwt_keyring = qctoken.keyring_from_config(config)
+        jwt_expiry  = config.get("authentication", "jwt_expiry")
 
 #       if (not config.getboolean("authentication","anon")):
 #          jwt_code = random_key()
 
-        logging.info("JWT key:    " + jwt_code)
+        logging.info("JWT keys:   %s (active %s)" %
+           (", ".join(sorted(jwt_keyring.macs)), jwt_keyring.active))
         logging.info("JWT expiry: " + jwt_expiry)
 
         usr_man = user_manager.UserManager(config)
 
-        args = dict(jwt_code     = jwt_code, 
+        # Revoked tokens are kept in memory, updated by the run coroutine
+        self.revocations = RevocationList(config)
+
+        args = dict(jwt_keyring  = jwt_keyring, 
                     jwt_expiry   = jwt_expiry,
-                    user_manager = usr_man)
+                    user_manager = usr_man,
+                    revocations  = self.revocations,
+                    rate_limiter = RateLimiter(usr_man.rdb, config))
 
         handlers = [
             (r"/token",    RequestToken,     args),
+            (r"/refresh",  RefreshToken,     args),
+            (r"/revoke",   RevokeToken,      args),
             (r"/adduser",  AddUser,          args),
+            (r"/deleteuser", DeleteUser,     args),
             (r"/register", AddAnonymousUser, args),
             (r"/validate", ValidateToken,    args),
         ]
@@ -263,7 +352,8 @@ if __name__ == "__main__":
    logging.info("Loading certificate files: '{0}', '{1}' ".format(cert, key))
    ssl_context.load_cert_chain(cert, key)
 
-   server = tornado.httpserver.HTTPServer(AuthenticationServer(config), 
+   application = AuthenticationServer(config)
+   server = tornado.httpserver.HTTPServer(application, 
 #     ssl_options = ssl_context
    )
    port = config.get("authentication", "port")
@@ -273,4 +363,5 @@ if __name__ == "__main__":
    else:
       logging.info("Authentication server running on port %s" % port)
 
+   tornado.ioloop.IOLoop.current().spawn_callback(application.revocations.run)
    tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,71 @@
+#
+#  Measures the rate at which a running authentication server issues tokens
+#  to concurrent clients:
+#
+#     python3 benchmark_token.py http://localhost:8882 user password \
+#        --requests 200 --concurrency 16
+#
+#  Each request to /token checks the password with bcrypt, so the rate
+#  shows how well the hashing pool uses the cores of the server.
+#
+
+import time
+import argparse
+
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+
+
+
+async def issue_tokens(url, user, password, count, latencies, errors):
+    client = tornado.httpclient.AsyncHTTPClient()
+    headers = { "Qcloud-Client-User" : user, "Qcloud-Client-Password" : password }
+    for i in range(count):
+        start = time.time()
+        response = await client.fetch(url + "/token", headers=headers, raise_error=False)
+        latencies.append(time.time() - start)
+        if (response.code != 200 or response.headers.get("Qcloud-Server-Status") != "OK"):
+           errors.append(response.headers.get("Qcloud-Server-Message", str(response.code)))
+
+
+
+async def benchmark(args):
+    latencies = []
+    errors = []
+    per_client = max(args.requests // args.concurrency, 1)
+
+    start = time.time()
+    await tornado.gen.multi([issue_tokens(args.url, args.user, args.password,
+       per_client, latencies, errors) for i in range(args.concurrency)])
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print("Requests:    %d  (%d failed)" % (len(latencies), len(errors)))
+    print("Concurrency: %d" % args.concurrency)
+    print("Elapsed:     %.2f s" % elapsed)
+    print("Throughput:  %.1f tokens/s" % ((len(latencies) - len(errors)) / elapsed))
+    print("Latency:     median %.0f ms  p95 %.0f ms  max %.0f ms" %
+       (1000*latencies[len(latencies)//2], 1000*latencies[int(0.95*(len(latencies)-1))],
+        1000*latencies[-1]))
+    if (errors):
+       print("First error: " + errors[0])
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark token issuance")
+    parser.add_argument("url", help="authentication server, e.g. http://localhost:8882")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("--requests", default=200, type=int)
+    parser.add_argument("--concurrency", default=16, type=int)
+    args = parser.parse_args()
+
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    tornado.ioloop.IOLoop.current().run_sync(lambda: benchmark(args))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,35 @@
 import re
+import time
 import uuid
 import redis
 import bcrypt
+import hashlib
 import logging
+import secrets
+import concurrent.futures
+
+import tornado.ioloop
+
+from token_revocations import revoke
+
+
+
+def hash_password(password, rounds):
+    """Returns a bcrypt hash of the password with a salt of its own"""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+
+def check_password(password, hashpw):
+    """Returns True if the password matches the bcrypt hash.  The salt is
+    read from the hash, so this works for hashes made with the global salt
+    as well as for those with a salt of their own."""
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashpw.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
 
     
 class UserManager():
@@ -15,35 +42,44 @@ class UserManager():
         self.rdb = redis.StrictRedis(host=host, port=port, db=0, 
            charset='utf-8', decode_responses=True)
 
-        salt = bytes(config.get("authentication", "salt").encode())
-        logging.info("Using salt:  {0}  of type  {1}".format(salt, type(salt)))
+        # Passwords used to be hashed with this salt, hashes made with it
+        # are replaced with ones with a salt of their own on login
+        self.salt  = config.get("authentication", "salt", fallback="")
+        self.rounds = config.getint("authentication", "bcrypt_rounds", fallback=12)
+
+        # bcrypt holds the GIL for the whole hash, so hashing is done in
+        # other processes to keep the IOLoop responsive
+        workers = config.getint("authentication", "hash_workers", fallback=None)
+        self.hasher = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
 
-        self.salt  = salt
         self.anon  = config.getboolean("authentication", "anon")
+        self.anon_ttl = config.getint("retention", "anon_user_ttl", fallback=0)
         self.admin = config.get("authentication", "admin_account")
 
+        # Refresh tokens let clients get new access tokens without their
+        # password until they expire or are revoked
+        self.refresh_expiry = config.getint("authentication", "refresh_expiry", fallback=30*86400)
+
         self.set_admin_password(config.get("authentication", "admin_password"))
         self.userid_re = re.compile("^[a-z0-9]{32}$")
         self.username_re = re.compile("^[a-zA-Z0-9_.-]+$")
 
         
 
-    def add_user(self, user, password, authentication):
+    async def add_user(self, user, password, authentication):
         if (self.anon):
            raise Exception("Invalid add user request for anonymous server")
 
-        if (not self.authenticate_user(self.admin, authentication)):
+        if (not await self.authenticate_user(self.admin, authentication)):
            raise Exception("Invalid Admin password, permission denied")
 
         if (not self.username_is_valid(user)):
            raise Exception("Invalid username: " + user)
 
         userid = uuid.uuid4().hex
-        hashpw = bcrypt.hashpw(password.encode('utf-8'), self.salt)
-        hashpw = hashpw.decode('utf-8')
-        self.rdb.hset("user:"+user, 'id', userid) 
-        self.rdb.hset("user:"+user, 'pw', hashpw) 
-        logging.info("Setting password hash for user " + user + " to " + hashpw)
+        hashpw = await self.run_hasher(hash_password, password, self.rounds)
+        self.rdb.hset("user:"+user, mapping={ 'id' : userid, 'pw' : hashpw })
+        logging.info("Setting password hash for user " + user)
         return userid
 
 
@@ -54,31 +90,116 @@ class UserManager():
 
         userid = uuid.uuid4().hex
         self.rdb.hset("user:"+userid, 'id', userid) 
+        self.touch_anonymous_user(userid)
         return userid
 
 
 
-    def delete_user(self, user, authentication):
+    def touch_anonymous_user(self, userid):
+        """Anonymous users expire after anon_user_ttl seconds without
+        authenticating, together with the list of their tokens.  qcweb
+        extends both as it verifies their tokens."""
+        if (self.anon_ttl > 0 and userid != self.admin):
+           with self.rdb.pipeline() as p:
+               p.expire("user:"+userid, self.anon_ttl)
+               p.expire("tokens:"+userid, self.anon_ttl)
+               p.execute()
+
+
+
+    async def delete_user(self, user, authentication):
         if (not self.user_exists(user)):
            raise Exception("Unknown user: " + user)
-        if (user == self.admin or not self.authenticate_user(self.admin, authentication)):
+        if (user == self.admin or not await self.authenticate_user(self.admin, authentication)):
            raise Exception("Invalid Admin password, permission denied")
 
         keys = list(self.rdb.hgetall("user:"+user).keys())
         self.rdb.hdel("user:"+user, *keys)
+        self.revoke_refresh_tokens(user)
+        self.revoke_tokens(user)
 
 
 
-    def add_token(self, token, user):
+    def add_token(self, jti, exp, user):
+        """Records the jti of a token issued to the user, scored by its
+        expiry, so the user's tokens can be revoked.  Expired entries are
+        dropped as new ones are added, and the list itself expires with the
+        last of its tokens.  Tokens that do not expire are kept as long as
+        the user is."""
         if (not self.user_exists(user)):
            raise Exception("Unknown user: " + user)
 
-        self.rdb.rpush("tokens", token)
-        self.rdb.dump("tokens")
+        with self.rdb.pipeline() as p:
+            p.zremrangebyscore("tokens:"+user, "-inf", time.time())
+            p.zadd("tokens:"+user, { jti : exp or "inf" })
+            p.zrange("tokens:"+user, -1, -1, withscores=True)
+            latest = p.execute()[2][0][1]
+
+        if (latest != float("inf")):
+           self.rdb.expireat("tokens:"+user, int(latest) + 1)
+        elif (self.anon):
+           self.touch_anonymous_user(user)
+        else:
+           self.rdb.persist("tokens:"+user)
         return True
 
 
 
+    def revoke_tokens(self, user):
+        """Revokes every unexpired access token issued to the user"""
+        tokens = self.rdb.zrangebyscore("tokens:"+user, time.time(), "+inf", withscores=True)
+        with self.rdb.pipeline() as p:
+            for (jti, exp) in tokens:
+                revoke(p, jti, None if exp == float("inf") else exp)
+            p.delete("tokens:"+user)
+            p.execute()
+        return len(tokens)
+
+
+
+    def add_refresh_token(self, user, userid):
+        """Returns a new refresh token for the user.  Only its hash is
+        stored, under refresh:<sha256>, and the hashes of each user's tokens
+        are kept so they can all be revoked."""
+        token = secrets.token_urlsafe(32)
+        key = "refresh:" + hashlib.sha256(token.encode()).hexdigest()
+        with self.rdb.pipeline() as p:
+            p.hset(key, mapping={ 'user' : user, 'id' : userid })
+            p.expire(key, self.refresh_expiry)
+            p.sadd("refresh:user:"+user, key)
+            p.expire("refresh:user:"+user, self.refresh_expiry)
+            p.execute()
+        return token
+
+
+
+    def use_refresh_token(self, token):
+        """Returns the user name and id for a valid refresh token"""
+        key = "refresh:" + hashlib.sha256(token.encode()).hexdigest()
+        entry = self.rdb.hgetall(key)
+        if (not entry or not self.user_exists(entry['user'])):
+           raise Exception("Invalid refresh token")
+        return (entry['user'], entry['id'])
+
+
+
+    def revoke_refresh_token(self, token):
+        key = "refresh:" + hashlib.sha256(token.encode()).hexdigest()
+        user = self.rdb.hget(key, 'user')
+        with self.rdb.pipeline() as p:
+            p.delete(key)
+            if (user is not None):
+               p.srem("refresh:user:"+user, key)
+            p.execute()
+
+
+
+    def revoke_refresh_tokens(self, user):
+        keys = list(self.rdb.smembers("refresh:user:"+user))
+        self.rdb.delete("refresh:user:"+user, *keys)
+
+
+
     def username_is_valid(self, user):
         if (user == self.admin):
            return False
@@ -97,18 +218,44 @@ class UserManager():
 
 
 
-    def authenticate_user(self, user, password):
+    async def authenticate_user(self, user, password):
         if (self.anon):
-           return self.user_exists(user)
+           if (not self.user_exists(user)):
+              return False
+           self.touch_anonymous_user(user)
+           return True
         else:
-           hashpw = bcrypt.hashpw(password.encode('utf-8'), self.salt)
-           hashpw = hashpw.decode('utf-8')
-           logging.info("Hashed password for user {0} : {1}".format(user, hashpw))
-
            if (not self.user_exists(user)):
               raise Exception("Unknown user: " + user)
-              
-           return (self.rdb.hget("user:"+user, 'pw') == hashpw)
+
+           hashpw = self.rdb.hget("user:"+user, 'pw')
+           if (hashpw is None or not await self.run_hasher(check_password, password, hashpw)):
+              return False
+
+           # The admin password comes from the config file and is left as it is
+           if (user != self.admin and self.needs_rehash(hashpw)):
+              hashpw = await self.run_hasher(hash_password, password, self.rounds)
+              self.rdb.hset("user:"+user, 'pw', hashpw)
+              logging.info("Upgraded password hash for user " + user)
+           return True
+
+
+
+    def needs_rehash(self, hashpw):
+        """Returns True for hashes made with the global salt or with fewer
+        rounds than are now configured"""
+        if (self.salt and hashpw.startswith(self.salt)):
+           return True
+        try:
+            return int(hashpw.split('$')[2]) < self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+
+    async def run_hasher(self, func, *args):
+        loop = tornado.ioloop.IOLoop.current()
+        return await loop.run_in_executor(self.hasher, func, *args)
 
 
 
@@ -118,7 +265,7 @@ class UserManager():
         #hashpw = bcrypt.hashpw(password.encode('utf-8'), self.salt)
         #hashpw = hashpw.decode('utf-8')
         hashpw = password
-        logging.info("Setting qcloud administrator password {}".format(hashpw))
+        logging.info("Setting qcloud administrator password")
         self.rdb.hset("user:"+self.admin, 'id', userid)
         self.rdb.hset("user:"+self.admin, 'pw', hashpw)
         return userid
@@ -1,11 +1,12 @@
 import os
-import json
 import uuid
 import redis
 import kombu
 import logging
 
+from job_store import JobStore
 from local_queue import LocalQueue
+from workdir_layout import find_job_path, make_job_path
 
 
 class ComputationalJob():
@@ -25,6 +26,7 @@ class JobManager():
         redis_port = config.get("redis", "port")
         self.db = redis.StrictRedis(host=redis_host, port=redis_port, db=0,
            charset="utf-8", decode_responses=True)
+        self.store = JobStore(self.db)
 
         queue_host = config.get("queue", "host")
         queue_port = config.get("queue", "port")
@@ -33,6 +35,7 @@ class JobManager():
         self.kombu.ensure_connection(max_retries=5)
 
         self.workdir = config.get("queue", "workdir")
+        self.layout = config.get("queue", "workdir_layout", fallback="flat")
         self.queue = LocalQueue(self.db, self.kombu)
 
     def close_connection(self):
@@ -48,21 +51,19 @@ class JobManager():
 
     def create_job(self, job_input):
         jobid = uuid.uuid1().hex
-        job_workdir = self.get_job_workdir(jobid)
-        os.mkdir(job_workdir)
+        job_workdir = make_job_path(self.workdir, jobid, self.layout)
         finput = open("%s/input" % job_workdir, "w")
         finput.write(job_input)
         finput.close()
         job = ComputationalJob(jobid, "NEW", [])
-        self.db.set("job:%s" % jobid, json.dumps(job.__dict__))
+        self.store.create(jobid, { "status" : "NEW", "files" : [] })
         return job
 
     def get_job(self, jobid):
-        job = self.db.get("job:%s" % jobid)
-        if (job is None):
+        doc = self.store.get(jobid)
+        if (doc is None):
            return ComputationalJob(jobid, "DNE", [])
         else:
-           doc = json.loads(job)
            return ComputationalJob(jobid, doc["status"], doc["files"])
 
     def get_job_file(self, jobid, fname):
@@ -76,31 +77,14 @@ class JobManager():
         return fpath
 
     def get_job_workdir(self, jobid):
-        return "%s/%s" % (self.workdir, jobid)
+        return find_job_path(self.workdir, jobid, self.layout)
 
     def update_job_status(self, jobid, status):
-        self.__update_job_descriptor(jobid, [("status", status)])
+        self.store.transition(jobid, None, { "status" : status })
 
     def update_job_status_error(self, jobid, msg):
-        self.__update_job_descriptor(jobid,
-                [("status", "ERROR"), ("error", msg)])
+        self.store.transition(jobid, None, { "status" : "ERROR", "error" : msg })
 
     def update_job_files(self, jobid):
         files = os.listdir(self.get_job_workdir(jobid))
-        self.__update_job_descriptor(jobid, [("files", files)])
-
-    def __update_job_descriptor(self, jobid, nvpairs):
-        jobkey = "job:%s" % jobid
-        with self.db.pipeline() as p:
-            while 1:
-                try:
-                    p.watch(jobkey)
-                    doc = json.loads(p.get(jobkey))
-                    for nvpair in nvpairs:
-                        doc[nvpair[0]] = nvpair[1]
-                    p.multi()
-                    p.set(jobkey, json.dumps(doc))
-                    p.execute()
-                    break
-                except WatchError:
-                    continue
+        self.store.update(jobid, { "files" : files })
@@ -0,0 +1,37 @@
+import os
+
+
+# Job workdirs are either direct children of the workdir ("flat") or are
+# spread over two levels of subdirectories named after the first four
+# characters of the jobid ("sharded"), e.g. <workdir>/3f/a2/3fa2...
+layouts = ("flat", "sharded")
+
+
+
+def job_path(workdir, jobid, layout):
+    """Returns where the workdir of a new job goes in the given layout"""
+    if (layout == "sharded"):
+       return os.path.join(workdir, jobid[0:2], jobid[2:4], jobid)
+    return os.path.join(workdir, jobid)
+
+
+
+def find_job_path(workdir, jobid, layout):
+    """Returns the workdir of an existing job.  Jobs created before the
+    sharded layout was enabled and not yet migrated are still found at the
+    flat path."""
+    path = job_path(workdir, jobid, layout)
+    if (layout == "sharded" and not os.path.isdir(path)):
+       flat = os.path.join(workdir, jobid)
+       if (os.path.isdir(flat)):
+          return flat
+    return path
+
+
+
+def make_job_path(workdir, jobid, layout):
+    """Creates the workdir of a new job, and any shard directories needed"""
+    path = job_path(workdir, jobid, layout)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.mkdir(path)
+    return path
@@ -0,0 +1,61 @@
+import os
+import fnmatch
+import tarfile
+
+
+# A tar stream is terminated by two empty blocks
+TAR_BLOCK = 512
+TAR_END   = b'\0' * (2 * TAR_BLOCK)
+
+
+
+class ArchiveBuffer():
+    """Write-only file object used as the target of a ZipFile so that the
+    archive can be sent to the client as it is built"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+
+def select_files(workdir, include, exclude, names = None):
+    """Lists the regular files in workdir matching any of the include globs
+    (all files if none are given) and none of the exclude globs.  If the
+    names of the files are known, from a manifest, the workdir is not read."""
+    files = []
+    if (names is None):
+       names = [fname for fname in os.listdir(workdir)
+                   if os.path.isfile(os.path.join(workdir, fname))]
+    for fname in sorted(names):
+        if (include and not any(fnmatch.fnmatch(fname, p) for p in include)):
+           continue
+        if (any(fnmatch.fnmatch(fname, p) for p in exclude)):
+           continue
+        files.append(fname)
+    return files
+
+
+
+def tar_header(fname, stat):
+    info = tarfile.TarInfo(fname)
+    info.size  = stat.st_size
+    info.mtime = int(stat.st_mtime)
+    info.mode  = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+
+def tar_padding(size):
+    return b'\0' * ((TAR_BLOCK - size % TAR_BLOCK) % TAR_BLOCK)
@@ -0,0 +1,135 @@
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Suffixes of files stored compressed in the job workdir
+suffixes = { "gzip" : ".gz", "zstd" : ".zst" }
+
+
+
+def available():
+    """Returns the encodings that can be used, best first"""
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+
+def negotiate(accept_encoding, prefer = None):
+    """Returns the best encoding accepted by the client, or None.  The
+    preferred encoding, that of a file stored compressed, is chosen over
+    the others if the client accepts it."""
+    accepted = { }
+    for item in (accept_encoding or "").split(","):
+        fields = item.strip().split(";")
+        quality = 1.0
+        for param in fields[1:]:
+            (name, _, value) = param.strip().partition("=")
+            if (name == "q"):
+               try:
+                   quality = float(value)
+               except ValueError:
+                   quality = 0.0
+        accepted[fields[0].strip().lower()] = quality
+
+    for encoding in ([prefer] if prefer else []) + available():
+        if (accepted.get(encoding, accepted.get("*", 0)) > 0):
+           return encoding
+    return None
+
+
+
+class Compressor():
+    """Compresses a stream of chunks with the given encoding"""
+
+    def __init__(self, encoding):
+        if (encoding == "zstd"):
+           self.stream = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+           # wbits of 31 gives a gzip header and trailer
+           self.stream = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.stream.compress(data)
+
+    def finish(self):
+        return self.stream.flush()
+
+
+
+class Decompressor():
+    def __init__(self, encoding):
+        if (encoding == "zstd"):
+           self.stream = zstandard.ZstdDecompressor().decompressobj()
+        else:
+           self.stream = zlib.decompressobj(31)
+
+    def decompress(self, data):
+        return self.stream.decompress(data)
+
+
+
+def read_chunks(fpath, encoding, start, end, chunk_size):
+    """Yields the bytes from start up to end, or the end of the file if end
+    is None, of a file stored with the given encoding, or uncompressed if
+    encoding is None"""
+    with open(fpath, 'rb') as file:
+       if (encoding is None):
+          file.seek(start)
+          remaining = None if end is None else end - start
+          while (remaining is None or remaining > 0):
+              chunk = file.read(chunk_size if remaining is None else min(chunk_size, remaining))
+              if (not chunk):
+                 break
+              if (remaining is not None):
+                 remaining -= len(chunk)
+              yield chunk
+          return
+
+       # Compressed files are read from the beginning and the data before
+       # start is dropped
+       decompressor = Decompressor(encoding)
+       offset = 0
+       for chunk in iter(lambda: file.read(chunk_size), b''):
+           data = decompressor.decompress(chunk)
+           (first, offset) = (offset, offset + len(data))
+           if (offset <= start):
+              continue
+           data = data[max(start - first, 0):]
+           if (end is not None and offset >= end):
+              yield data[:len(data) - (offset - end)]
+              return
+           yield data
+
+
+
+def compress_chunks(chunks, encoding):
+    """Yields the chunks compressed with the given encoding"""
+    compressor = Compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if (data):
+           yield data
+    yield compressor.finish()
+
+
+
+def compress_file(fpath, encoding, chunk_size = 1024*1024):
+    """Writes a compressed copy of the file next to it, with the same mtime,
+    and returns its path.  The original is left for the caller to remove."""
+    stored = fpath + suffixes[encoding]
+    partial = stored + ".part"
+    compressor = Compressor(encoding)
+    with open(fpath, 'rb') as src, open(partial, 'wb') as dst:
+       for chunk in iter(lambda: src.read(chunk_size), b''):
+           dst.write(compressor.compress(chunk))
+       dst.write(compressor.finish())
+
+    stat = os.stat(fpath)
+    os.utime(partial, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.chown(partial, stat.st_uid, stat.st_gid)
+    os.replace(partial, stored)
+    return stored
@@ -0,0 +1,62 @@
+import json
+import time
+import sqlite3
+import threading
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+   jobid     TEXT PRIMARY KEY,
+   userid    TEXT,
+   status    TEXT,
+   submitted REAL,
+   retired   REAL,
+   record    TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_userid ON jobs (userid, submitted);
+"""
+
+
+
+class JobArchive():
+    """Keeps the records of jobs retired from redis in an SQLite database so
+    that old jobids can still be looked up.  Each thread uses its own
+    connection."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.__connection().executescript(schema)
+
+
+    def put(self, docs):
+        """Archives a list of (jobid, record) pairs in one transaction"""
+        now  = time.time()
+        rows = [(jobid, doc.get("userid"), doc.get("status"),
+                 float(doc.get("submitted", 0)), now,
+                 json.dumps(doc, separators=(",", ":"))) for (jobid, doc) in docs]
+        conn = self.__connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+    def get_many(self, jobids):
+        """Returns the archived records of the given jobs keyed by jobid"""
+        docs = { }
+        conn = self.__connection()
+        # Stay well below the SQLite limit on the number of parameters
+        for start in range(0, len(jobids), 500):
+            chunk = jobids[start:start+500]
+            query = "SELECT jobid, record FROM jobs WHERE jobid IN (%s)" % \
+                       ",".join("?" * len(chunk))
+            for (jobid, record) in conn.execute(query, chunk):
+                docs[jobid] = json.loads(record)
+        return docs
+
+
+    def __connection(self):
+        conn = getattr(self.local, "conn", None)
+        if (conn is None):
+           conn = sqlite3.connect(self.path)
+           self.local.conn = conn
+        return conn
@@ -1,13 +1,23 @@
 import os
 import re
 import json
+import time
 import uuid
+import shlex
 import redis
 import kombu
+import fnmatch
 import logging
-import subprocess
 
+from job_store import JobStore, final_states
+from job_archive import JobArchive
 from local_queue import LocalQueue
+from scheduler import create_scheduler
+from workdir_gc import disk_usage
+from job_manifest import build_manifest, add_checksums, file_checksum
+from compression import available, compress_file, suffixes
+from result_cache import ResultCache, succeeded
+from workdir_layout import find_job_path, make_job_path
 
 slurm_path="/opt/slurm/bin/"
 # These are the slurm user and group on the host machine
@@ -16,15 +26,21 @@ slurm_group=1000
 
 
 class ComputationalJob():
-    def __init__(self, jobid, slurmid, status, files):
-        self.jobid   = jobid
-        self.slurmid = slurmid
-        self.status  = status
-        self.files   = files
+    def __init__(self, jobid, slurmid, status, files, manifest = None, output = None):
+        self.jobid    = jobid
+        self.slurmid  = slurmid
+        self.status   = status
+        self.files    = files
+        self.manifest = manifest
+        self.output   = output or "output"
 
     def is_valid(self):
         return self.status != "DNE"
 
+    def is_submitted(self):
+        # Array tasks have ids of the form <arrayid>_<task>
+        return str(self.slurmid) != "-1"
+
 
 
 class JobManager():
@@ -33,6 +49,9 @@ class JobManager():
         redis_port = config.get("redis", "port")
         self.db = redis.StrictRedis(host=redis_host, port=redis_port, db=0,
            charset="utf-8", decode_responses=True)
+        self.store = JobStore(self.db, self.__retention(config), self.__archive(config),
+           [status for status in final_states if config.getint("gc",
+              "%s_age" % status.lower(), fallback=0) > 0])
 
         queue_host = config.get("queue", "host")
         queue_port = config.get("queue", "port")
@@ -41,17 +60,50 @@ class JobManager():
         self.kombu.ensure_connection(max_retries=5)
 
         self.workdir = config.get("queue", "workdir")
+        self.layout = config.get("queue", "workdir_layout", fallback="flat")
         self.queue = LocalQueue(self.db, self.kombu)
 
         self.qc = config.get("server", "qc")
         self.qcaux = config.get("server", "qcaux")
         self.qcscratch = config.get("server", "qcscratch")
 
+        self.scheduler = create_scheduler(config, slurm_path)
+        self.max_array_size = config.getint("queue", "max_array_size", fallback=1000)
+
+        # Per user limits on the space used by job workdirs, 0 for none
+        self.quota_bytes  = config.getint("gc", "quota_bytes", fallback=0)
+        self.quota_inodes = config.getint("gc", "quota_inodes", fallback=0)
+        self.tier_dir = config.get("gc", "tier_dir", fallback=None)
+
+        # How often the manifests of running jobs are brought up to date
+        self.manifest_period = config.getfloat("server", "manifest_period", fallback=60)
+
+        # Files of finished jobs matching compress_files are stored
+        # compressed with this encoding, "none" to leave them as they are
+        self.compress_outputs = config.get("server", "compress_outputs", fallback="none")
+        self.compress_files = config.get("server", "compress_files",
+           fallback="output *.out *.fchk").split()
+        self.compress_min_size = config.getint("server", "compress_min_size", fallback=4096)
+        if (self.compress_outputs != "none" and self.compress_outputs not in available()):
+           logging.warning("Compression %s not available, outputs will not be compressed"
+              % self.compress_outputs)
+           self.compress_outputs = "none"
+
+        # Successful results are reused for identical inputs.  The Q-Chem
+        # version is taken from the installation qc points to unless set.
+        self.result_cache = None
+        if (config.getboolean("cache", "enabled", fallback=False)):
+           self.result_cache = ResultCache(self.db,
+              config.get("cache", "qc_version", fallback=os.path.realpath(self.qc)),
+              config.getint("cache", "ttl", fallback=7*86400))
+
     def close_connection(self):
         self.kombu.close()
 
+    def submit_job(self, job_input, userid = None, use_cache = True):
+        if (not job_input.strip()):
+           raise Exception("Empty input")
 
-    def submit_job(self, job_input):
         match = re.match('\$slurm([\s\S]+?)\$end([\s\S]+)',job_input)
 
         if (bool(match)):
@@ -61,7 +113,7 @@ class JobManager():
            #job = self.create_job(job_input)
            #self.queue.emit_job_created(job.jobid)
 
-        job = self.create_job_slurm(slurm_input, job_input)
+        job = self.create_job_slurm(slurm_input, job_input, userid, use_cache)
 
         return job
 
@@ -69,35 +121,33 @@ class JobManager():
 
     def create_job(self, job_input):
         jobid = uuid.uuid1().hex
-        job_workdir = self.get_job_workdir(jobid)
-        os.mkdir(job_workdir)
+        job_workdir = make_job_path(self.workdir, jobid, self.layout)
 
         finput = open("%s/input" % job_workdir, "w")
         finput.write(job_input)
         finput.close()
         job = ComputationalJob(jobid, -1, "NEW", [])
-        self.db.set("job:%s" % jobid, json.dumps(job.__dict__))
+        self.store.create(jobid, { "slurmid" : -1, "status" : "NEW", "files" : [] })
         return job
 
 
-    def create_job_slurm(self, slurm_input, qchem_input):
+    def create_job_slurm(self, slurm_input, qchem_input, userid = None, use_cache = True):
+        """Writes the job files and records the job as PENDING.  The job is
+        passed to SLURM afterwards by submit_pending_job.  If the result
+        cache has a job with the same inputs its files are linked into the
+        new job, which is recorded as DONE straight away."""
+        match = re.search('--job-name[\s=]+(\S+)',slurm_input)
+        if (bool(match) and os.path.basename(match.group(1)) != match.group(1)):
+           raise Exception("Invalid job name " + match.group(1))
+
+        self.check_quota(userid, len(slurm_input) + len(qchem_input), 3)
+
         jobid = uuid.uuid1().hex
-        jobdir = self.get_job_workdir(jobid)
-        os.mkdir(jobdir)
+        jobdir = make_job_path(self.workdir, jobid, self.layout)
         os.chown(jobdir, slurm_user, slurm_group)
 
-        match = re.search('--job-name[\s=]+(\S+)',slurm_input)
-        if (bool(match)):
-           (base,ext) = os.path.splitext(match.group(1))
-           if (not (ext == ".inp" or ext == ".in" or ext == ".qcin")):
-              base = match.group(1)
-           batch_fname  = base + ".bat"
-           input_fname  = base + ".inp"
-           output_fname = base + ".out"
-        else:
-           batch_fname  = "batch"
-           input_fname  = "input"
-           output_fname = "output"
+        (batch_fname, input_fname, output_fname) = \
+           self.__job_filenames(match.group(1) if match else None)
 
         fname  = "%s/%s" % (jobdir, batch_fname)
         fh = open(fname, "w")
@@ -105,11 +155,7 @@ class JobManager():
         fh.write(slurm_input) 
         fh.write("\n")
         fh.write("#SBATCH --chdir={0}\n\n".format(jobdir))
-        # The following is a temp hack as qchem interrogates $HOME
-        fh.write("export HOME=/home/ec2-user\n")
-        fh.write("export QC={0}\n".format(self.qc))
-        fh.write("export QCAUX={0}\n".format(self.qcaux))
-        fh.write("export QCSCRATCH={0}\n".format(self.qcscratch))
+        self.__write_environment(fh)
         fh.write("$QC/bin/qchem {0} {1}\n".format(input_fname,output_fname))
         fh.close()
 
@@ -118,139 +164,576 @@ class JobManager():
         fh.write(qchem_input)
         fh.close()
 
-        cmd = '%s/sbatch %s/%s' % (slurm_path,jobdir,batch_fname)
-        output = subprocess.getoutput(cmd)
-        match  = re.match("Submitted batch job (\d+)", output)
-        slurmid = -1
+        key = None
+        if (self.result_cache is not None and use_cache):
+           key = self.result_cache.key(slurm_input, qchem_input)
+           job = self.__create_cached(jobid, jobdir, key, input_fname, output_fname, userid)
+           if (job is not None):
+              return job
+
+        (size, inodes) = disk_usage(jobdir)
+        job = ComputationalJob(jobid, -1, "PENDING", [])
+        doc = self.__owner(userid)
+        doc.update({ "slurmid" : -1, "status" : "PENDING", "files" : [], "batch" : batch_fname,
+           "input" : input_fname, "output" : output_fname, "bytes" : size, "inodes" : inodes })
+        if (key is not None):
+           doc["cachekey"] = key
+        with self.db.pipeline() as p:
+            self.store.create(jobid, doc, pipe=p)
+            self.add_usage(p, userid, size, inodes)
+            p.execute()
+        return job
+
+
+    def submit_pending_job(self, jobid):
+        """Passes a PENDING job to the scheduler.  This waits on the SLURM
+        controller and so is run on a worker thread."""
+        doc = self.store.get(jobid)
+        if (doc is None or doc["status"] != "PENDING"):
+           self.db.srem("jobs:pending", jobid)
+           return
+
+        try:
+            slurmid = self.scheduler.submit(self.get_job_workdir(jobid), doc["batch"])
+        except Exception as e:
+            logging.error("Submission failed; JID=%s: %s" % (jobid, str(e)))
+            self.store.transition(jobid, "PENDING", { "status" : "ERROR", "error" : str(e) })
+            return
+
+        if (not self.store.transition(jobid, "PENDING", { "slurmid" : slurmid, "status" : "QUEUED" })):
+           # The job was deleted while it was being submitted
+           self.scheduler.cancel(slurmid)
+
+
+    def pending_jobs(self):
+        return list(self.db.smembers("jobs:pending"))
+
+
+    def submit_batch(self, slurm_input, inputs, userid = None, use_cache = True):
+        """Creates a PENDING job for each (name, input) pair and writes
+        SLURM array scripts that run them.  Returns the jobs and the ids of
+        the arrays, which are passed to SLURM by submit_pending_array.
+        Inputs with a cached result are recorded as DONE and left out of
+        the arrays."""
+        match = re.match('\$slurm([\s\S]+?)\$end', slurm_input.strip())
         if (bool(match)):
-           slurmid = match.group(1)
-        else:
-           logging.error("Failed to determine SLURM jobid from output %s" % output)
+           slurm_input = match.group(1)
+        slurm_input = slurm_input.strip()
+
+        for (name, qchem_input) in inputs:
+            if (not name or os.path.basename(name) != name):
+               raise Exception("Invalid input name " + name)
+            if (not qchem_input.strip()):
+               raise Exception("Empty input " + name)
+
+        self.check_quota(userid, sum([len(qchem_input) for (name, qchem_input) in inputs]),
+           2*len(inputs))
+
+        jobs = []
+        queued = []
+        for (name, qchem_input) in inputs:
+            jobid = uuid.uuid1().hex
+            jobdir = make_job_path(self.workdir, jobid, self.layout)
+            os.chown(jobdir, slurm_user, slurm_group)
+
+            (batch_fname, input_fname, output_fname) = self.__job_filenames(name)
+            with open("%s/%s" % (jobdir, input_fname), "w") as fh:
+               fh.write(qchem_input)
+
+            (key, job) = (None, None)
+            if (self.result_cache is not None and use_cache):
+               key = self.result_cache.key(slurm_input, qchem_input)
+               job = self.__create_cached(jobid, jobdir, key, input_fname, output_fname, userid)
+            if (job is None):
+               job = ComputationalJob(jobid, -1, "PENDING", [])
+               queued.append((jobid, jobdir, input_fname, output_fname, key))
+            jobs.append(job)
+
+        arrays = []
+        for start in range(0, len(queued), self.max_array_size):
+            arrayid = uuid.uuid1().hex
+            tasks = queued[start:start+self.max_array_size]
+
+            arraydir = self.get_array_workdir(arrayid)
+            os.makedirs(arraydir)
+            os.chown(arraydir, slurm_user, slurm_group)
+
+            with open("%s/batch" % arraydir, "w") as fh:
+               fh.write("#!/bin/bash\n")
+               fh.write(slurm_input)
+               fh.write("\n")
+               fh.write("#SBATCH --array=0-{0}\n".format(len(tasks)-1))
+               fh.write("#SBATCH --chdir={0}\n".format(arraydir))
+               fh.write("#SBATCH --output={0}/slurm-%A_%a.out\n\n".format(arraydir))
+               self.__write_environment(fh)
+               for (field, name) in ((1, "jobdirs"), (2, "inputs"), (3, "outputs")):
+                   fh.write("%s=(\n" % name)
+                   for task in tasks:
+                       fh.write("   %s\n" % shlex.quote(task[field]))
+                   fh.write(")\n")
+               fh.write("cd ${jobdirs[$SLURM_ARRAY_TASK_ID]}\n")
+               fh.write("$QC/bin/qchem ${inputs[$SLURM_ARRAY_TASK_ID]} ${outputs[$SLURM_ARRAY_TASK_ID]}\n")
+
+            with self.db.pipeline() as p:
+                for (task, (jobid, jobdir, input_fname, output_fname, key)) in enumerate(tasks):
+                    (size, inodes) = disk_usage(jobdir)
+                    doc = self.__owner(userid)
+                    doc.update({ "slurmid" : -1, "status" : "PENDING", "files" : [],
+                       "array" : arrayid, "task" : task, "input" : input_fname,
+                       "output" : output_fname, "bytes" : size, "inodes" : inodes })
+                    if (key is not None):
+                       doc["cachekey"] = key
+                    self.store.create(jobid, doc, pipe=p)
+                    self.add_usage(p, userid, size, inodes)
+                p.set("array:%s" % arrayid, json.dumps([task[0] for task in tasks]))
+                p.sadd("arrays:pending", arrayid)
+                # The workdir GC removes the array workdir after those of
+                # all its tasks
+                p.hset("arrays:tasks", arrayid, len(tasks))
+                p.execute()
+            arrays.append(arrayid)
+
+        return (jobs, arrays)
+
+
+    def submit_pending_array(self, arrayid):
+        """Submits a job array written by submit_batch with a single call to
+        the scheduler"""
+        jobids = self.db.get("array:%s" % arrayid)
+        if (jobids is None):
+           self.db.srem("arrays:pending", arrayid)
+           return
+        jobids = json.loads(jobids)
+
+        try:
+            slurmid = self.scheduler.submit(self.get_array_workdir(arrayid), "batch")
+            error = None
+        except Exception as e:
+            logging.error("Array submission failed; AID=%s: %s" % (arrayid, str(e)))
+            error = str(e)
+
+        for (task, jobid) in enumerate(jobids):
+            if (error is not None):
+               self.store.transition(jobid, "PENDING", { "status" : "ERROR", "error" : error })
+               continue
+
+            taskid = "%s_%d" % (slurmid, task)
+            if (not self.store.transition(jobid, "PENDING", { "slurmid" : taskid, "status" : "QUEUED" })):
+               # The job was deleted while the array was being submitted
+               self.scheduler.cancel(taskid)
 
-        job = ComputationalJob(jobid, slurmid, "QUEUED", [])
-        self.db.set("job:%s" % jobid, json.dumps(job.__dict__))
-        return job
+        with self.db.pipeline() as p:
+            p.delete("array:%s" % arrayid)
+            p.srem("arrays:pending", arrayid)
+            p.execute()
+
+
+    def pending_arrays(self):
+        return list(self.db.smembers("arrays:pending"))
 
 
-    def delete_job(self, jobid):
+    def delete_job(self, jobid, userid = None):
+        """Cancels the job, which must belong to the user if one is given"""
         #self.queue.emit_job_termination_requested(jobid)
-        job = self.get_job(jobid)
+        job = self.get_job(jobid, userid)
+        if (not job.is_valid()):
+           raise Exception("Invalid jobid " + jobid)
+        if (job.status == "PENDING"):
+           if (self.store.transition(jobid, "PENDING", { "status" : "DELETED" })):
+              return
+           job = self.get_job(jobid, userid)
+
         slurmid = job.slurmid
-        if (int(slurmid) > 0):
-           cmd = '%s/scancel %s' % (slurm_path,slurmid)
-           output = subprocess.getoutput(cmd)
-           #logging.info("scancel returned: %s" % output)
+        if (job.is_submitted()):
+           self.scheduler.cancel(slurmid)
            self.update_job_status(jobid, "DELETED")
-            
 
 
-    def get_job(self, jobid):
-        job = self.db.get("job:%s" % jobid)
-        if (job is None):
+
+    def get_job(self, jobid, userid = None):
+        """Returns the job, which does not exist as far as the user is
+        concerned if it was submitted by someone else"""
+        doc = self.store.get(jobid, userid)
+        if (doc is None):
            return ComputationalJob(jobid, -1, "DNE", [])
         else:
-           doc = json.loads(job)
-           job = ComputationalJob(jobid, doc["slurmid"], doc["status"], doc["files"])
-           self.update_job(job)
-           return job
+           return ComputationalJob(jobid, doc["slurmid"], doc["status"], doc["files"],
+              doc.get("manifest"), doc.get("output"))
+
+
+
+    def get_jobs(self, jobids, userid = None):
+        """Reads the records of several jobs in a single round trip"""
+        if (not jobids):
+           return []
+
+        jobs = []
+        for (jobid, doc) in zip(jobids, self.store.get_many(jobids, userid)):
+            if (doc is None):
+               jobs.append(ComputationalJob(jobid, -1, "DNE", []))
+            else:
+               jobs.append(ComputationalJob(jobid, doc["slurmid"], doc["status"], doc["files"],
+                  doc.get("manifest"), doc.get("output")))
+        return jobs
+
+
+
+    def list_jobs(self, userid, statuses = None, cursor = None, count = 50):
+        """Returns a page of the user's jobs, newest first, as a list of
+        (job, submit time) pairs and the cursor for the next page"""
+        (entries, cursor) = self.store.user_jobs(userid, statuses, cursor, count)
+        jobs = self.get_jobs([jobid for (jobid, submitted) in entries])
+        return (list(zip(jobs, [submitted for (jobid, submitted) in entries])), cursor)
+
+
+
+    def retire_jobs(self):
+        retired = self.store.retire()
+        if (retired > 0):
+           logging.info("Retired %d job records" % retired)
+
+
+
+    def get_usage(self, userid):
+        """Returns the bytes and inodes used by the user's workdirs"""
+        usage = self.db.hmget("usage:%s" % userid, "bytes", "inodes")
+        return (int(usage[0] or 0), int(usage[1] or 0))
+
+
+
+    def add_usage(self, pipe, userid, size, inodes):
+        if (userid is not None):
+           pipe.hincrby("usage:%s" % userid, "bytes", size)
+           pipe.hincrby("usage:%s" % userid, "inodes", inodes)
+
+
+
+    def check_quota(self, userid, size, inodes):
+        """Raises an exception if adding the given space would take the user
+        over their quota"""
+        if (userid is None or (self.quota_bytes <= 0 and self.quota_inodes <= 0)):
+           return
+
+        (used_bytes, used_inodes) = self.get_usage(userid)
+        if (self.quota_bytes > 0 and used_bytes + size > self.quota_bytes):
+           raise Exception("Disk quota exceeded: %d of %d bytes used" %
+              (used_bytes, self.quota_bytes))
+        if (self.quota_inodes > 0 and used_inodes + inodes > self.quota_inodes):
+           raise Exception("Disk quota exceeded: %d of %d files used" %
+              (used_inodes, self.quota_inodes))
 
 
 
     def get_job_info(self, job):
-        sid = int(job.slurmid)
         info = ''
-        if (sid > 0):
-            cmd = f"{slurm_path}/scontrol show job {sid}"
-            info = subprocess.getoutput(cmd)
-            #logging.info("scontrol command:  {}".format(cmd))
-            #logging.info("scontrol type:     {}".format(type(info)))
-            #logging.info("scontrol returned: {}".format(info))
+        if (job.is_submitted()):
+            info = self.scheduler.info(job.slurmid)
 
         return info 
 
 
-    # valid status: QUEUED, RUNNING, DONE, ERROR, DELETED, INVALID
-
-    def update_job(self, job):
-        if (int(job.slurmid) > 0):
-           if (job.status == "QUEUED" or job.status == "RUNNING"):
-              cmd = '%s/squeue -h --job %s' % (slurm_path,job.slurmid)
-              output = subprocess.getoutput(cmd)
-              #logging.info("squeue returned: %s" % output)
-              tokens = output.lstrip().rstrip().split()
-
-              if (len(tokens) > 4):
-                 token = tokens[4]
-                 if (token == "R" or token == "CG"):
-                    job.status = "RUNNING"
-                 else:
-                    job.status = "QUEUED"
-              else:
-                 job.status = "DONE"
-
-              self.update_job_status(job.jobid,job.status)
-              if (job.status == "DONE"):
-                 self.update_job_files(job.jobid)
-        
-    def update_job(self, job):
-        if (int(job.slurmid) > 0):
-           if (job.status == "QUEUED" or job.status == "RUNNING"):
-              cmd = '%s/squeue -h --job %s' % (slurm_path,job.slurmid)
-              output = subprocess.getoutput(cmd)
-              #logging.info("squeue returned: %s" % output)
-              tokens = output.lstrip().rstrip().split()
-
-              if (len(tokens) > 4):
-                 token = tokens[4]
-                 if (token == "R" or token == "CG"):
-                    job.status = "RUNNING"
-                 else:
-                    job.status = "QUEUED"
-              else:
-                 job.status = "DONE"
-
-              self.update_job_status(job.jobid,job.status)
-              if (job.status == "DONE"):
-                 self.update_job_files(job.jobid)
- 
-              
+    # valid status: PENDING, QUEUED, RUNNING, DONE, ERROR, DELETED, INVALID
+
+    def migrate(self):
+        """Converts job records written by earlier versions"""
+        self.store.migrate()
+
+
+    def reconcile(self):
+        """Updates the status of all active jobs from a single squeue call.
+        Jobs no longer known to SLURM are marked DONE and their file lists
+        and manifests recorded, or ERROR if their workdir cannot be read,
+        and the manifests of running jobs are refreshed every
+        manifest_period seconds.  Each change is applied only if the job has
+        not moved on in the meantime, and all are sent in one pipeline."""
+        jobids = list(self.db.smembers("jobs:active"))
+        if (not jobids):
+           return
+
+        states = self.scheduler.states()
+        if (states is None):
+           return
+
+        stale = []
+        updates = []
+        for (jobid, doc) in zip(jobids, self.store.get_many(jobids)):
+            if (doc is None or
+               (doc["status"] != "QUEUED" and doc["status"] != "RUNNING")):
+               stale.append(jobid)
+               continue
+
+            token = states.get(str(doc["slurmid"]))
+            if (token is None):
+               status = "DONE"
+            elif (token == "R" or token == "CG"):
+               status = "RUNNING"
+            else:
+               status = "QUEUED"
+
+            fields = { }
+            if (status != doc["status"]):
+               fields["status"] = status
+            if (status == "DONE"):
+               jobdir = self.get_job_workdir(jobid)
+               try:
+                   fields["files"] = os.listdir(jobdir)
+                   fields["manifest"] = build_manifest(jobdir, doc.get("manifest"))
+                   (fields["bytes"], fields["inodes"]) = disk_usage(jobdir)
+               except OSError as e:
+                   # One missing workdir must not hold up the other jobs
+                   logging.error("Finished job files unreadable; JID=%s: %s" % (jobid, str(e)))
+                   fields = { "status" : "ERROR", "error" : "Job files could not be read" }
+            elif (status == "RUNNING" and
+               time.time() - float(doc.get("manifest_time", 0)) >= self.manifest_period):
+               # Only files that changed since the last pass lose their checksum
+               try:
+                   fields["manifest"] = build_manifest(self.get_job_workdir(jobid), doc.get("manifest"))
+                   fields["manifest_time"] = time.time()
+               except OSError as e:
+                   logging.warning("Manifest update failed; JID=%s: %s" % (jobid, str(e)))
+
+            if (fields):
+               updates.append((jobid, doc, fields))
+
+        with self.db.pipeline(transaction=False) as p:
+            if (stale):
+               p.srem("jobs:active", *stale)
+            for (jobid, doc, fields) in updates:
+                self.store.transition(jobid, doc["status"], fields, pipe=p)
+            results = p.execute()[1 if stale else 0:]
+
+        # The output of finished jobs is charged to their owners and queued
+        # for compression, and successful results are cached
+        with self.db.pipeline(transaction=False) as p:
+            for ((jobid, doc, fields), applied) in zip(updates, results):
+                if (applied and "bytes" in fields):
+                   self.add_usage(p, doc.get("userid"),
+                      fields["bytes"] - int(doc.get("bytes", 0)),
+                      fields["inodes"] - int(doc.get("inodes", 0)))
+                   if (self.compress_outputs != "none"):
+                      p.sadd("jobs:compress", jobid)
+                   if (self.result_cache is not None and doc.get("cachekey") and
+                      succeeded(os.path.join(self.get_job_workdir(jobid), doc.get("output", "output")))):
+                      self.result_cache.add(doc["cachekey"], jobid, p)
+            p.execute()
+
+
+    def compress_job_outputs(self, batch = 20):
+        """Compresses the outputs of the finished jobs queued by the
+        reconciler, returns the number of files compressed"""
+        count = 0
+        while True:
+            jobids = self.db.spop("jobs:compress", batch)
+            if (not jobids):
+               return count
+            for jobid in jobids:
+                count += self.compress_job(jobid)
+
+
+    def compress_job(self, jobid):
+        """Stores the files of a finished job that match compress_files
+        compressed.  The manifest records the encoding and stored name of
+        each one, while its size stays that of the uncompressed file."""
+        doc = self.store.get(jobid)
+        if (doc is None or doc["status"] != "DONE" or "manifest" not in doc):
+           return 0
+
+        jobdir = self.get_job_workdir(jobid)
+        manifest = doc["manifest"]
+        compressed = []
+        saved = 0
+        try:
+            for (fname, entry) in manifest.items():
+                if ("encoding" in entry or entry["size"] < self.compress_min_size or
+                   not any(fnmatch.fnmatch(fname, p) for p in self.compress_files)):
+                   continue
+                # Checksums are of the uncompressed file
+                fpath = os.path.join(jobdir, fname)
+                if ("sha256" not in entry):
+                   entry["sha256"] = file_checksum(fpath)
+                stored = compress_file(fpath, self.compress_outputs)
+                entry["encoding"] = self.compress_outputs
+                entry["stored"] = os.path.basename(stored)
+                entry["stored_size"] = os.path.getsize(stored)
+                saved += entry["size"] - entry["stored_size"]
+                compressed.append(fname)
+        except OSError as e:
+            logging.error("Output compression failed; JID=%s: %s" % (jobid, str(e)))
+
+        if (not compressed):
+           return 0
+
+        # The originals are removed only once the manifest points readers
+        # at the compressed copies
+        self.store.update(jobid, { "manifest" : manifest,
+           "bytes" : int(doc.get("bytes", 0)) - saved })
+        with self.db.pipeline(transaction=False) as p:
+            self.add_usage(p, doc.get("userid"), -saved, 0)
+            p.execute()
+        for fname in compressed:
+            os.unlink(os.path.join(jobdir, fname))
+        return len(compressed)
 
     def get_job_file(self, jobid, fname):
         fpath = "%s/%s" % (self.get_job_workdir(jobid), fname)
         if not os.path.isfile(fpath): return None
         return file(fpath)
 
-    def get_job_filepath(self, jobid, fname):
-        fpath = "%s/%s" % (self.get_job_workdir(jobid), fname)
-        if not os.path.isfile(fpath): return None
+    def get_job_filepath(self, jobid, fname, manifest = None):
+        """Returns the path of a file in the job workdir, or None if there
+        is no such file.  The manifest is used to check, if there is one, and
+        for compressed files gives the path of the compressed copy.  Names
+        that would lead outside the workdir are not found."""
+        if (not fname or os.path.basename(fname) != fname):
+           return None
+        jobdir = self.get_job_workdir(jobid)
+        if (manifest is not None):
+           # Files stored compressed are found under their stored name
+           if (fname not in manifest):
+              return None
+           fname = manifest[fname].get("stored", fname)
+        fpath = "%s/%s" % (jobdir, fname)
+        if (os.path.dirname(os.path.realpath(fpath)) != os.path.realpath(jobdir)):
+           return None
+        if (manifest is None and not os.path.isfile(fpath)): return None
         return fpath
 
+    def get_manifest(self, job, checksums = False):
+        """Returns the manifest of the job, with the sha256 of each file if
+        checksums is set and the job has finished.  Manifests built or
+        completed here are saved for finished jobs."""
+        jobdir = self.get_job_workdir(job.jobid)
+        manifest = job.manifest
+        changed = False
+        if (manifest is None):
+           manifest = build_manifest(jobdir) if os.path.isdir(jobdir) else { }
+           changed = True
+        if (checksums and job.status == "DONE"):
+           changed = add_checksums(jobdir, manifest) or changed
+        if (changed and job.status == "DONE"):
+           self.store.update(job.jobid, { "manifest" : manifest })
+        return manifest
+
     def get_job_workdir(self, jobid):
-        return "%s/%s" % (self.workdir, jobid)
+        jobdir = find_job_path(self.workdir, jobid, self.layout)
+        if (self.tier_dir and not os.path.isdir(jobdir)):
+           tiered = find_job_path(self.tier_dir, jobid, self.layout)
+           if (os.path.isdir(tiered)):
+              return tiered
+        return jobdir
+
+    def get_array_workdir(self, arrayid):
+        return "%s/arrays/%s" % (self.workdir, arrayid)
+
+    def __job_filenames(self, name):
+        """Returns the batch, input and output file names for a job with
+        the given name"""
+        if (not name):
+           return ("batch", "input", "output")
+
+        (base,ext) = os.path.splitext(name)
+        if (not (ext == ".inp" or ext == ".in" or ext == ".qcin")):
+           base = name
+        return (base + ".bat", base + ".inp", base + ".out")
+
+    def __retention(self, config):
+        """Returns the time in seconds that jobs are kept in redis after
+        reaching each final state, 0 keeps them indefinitely"""
+        retention = { }
+        for status in ("DONE", "ERROR", "DELETED"):
+            retention[status] = config.getint("retention",
+               "%s_ttl" % status.lower(), fallback=0)
+        return retention
+
+    def __archive(self, config):
+        path = config.get("retention", "archive", fallback=None)
+        if (not path):
+           logging.warning("No job archive configured, retired job records will be discarded")
+           return None
+        return JobArchive(path)
+
+    def __create_cached(self, jobid, jobdir, key, input_fname, output_fname, userid):
+        """Links the files of the cached result for key into the new job and
+        records it as DONE.  Returns None if there is no usable result."""
+        srcid = self.result_cache.lookup(key)
+        if (srcid is None):
+           return None
+
+        src = self.store.get(srcid)
+        srcdir = self.get_job_workdir(srcid)
+        if (src is None or src["status"] != "DONE" or "manifest" not in src or
+           src.get("workdir") is not None or not os.path.isdir(srcdir)):
+           # The result has been deleted, or its workdir reclaimed
+           self.result_cache.forget(key, srcid)
+           return None
+
+        # Files named after the input or output of the earlier job are
+        # renamed after those of the new one, and the new input and batch
+        # script are kept
+        src_input = src.get("input", "input")
+        src_output = src.get("output", "output")
+        def rename(fname):
+            if (fname == src_output):
+               return output_fname
+            if (fname.startswith(src_input)):
+               return input_fname + fname[len(src_input):]
+            return fname
+
+        manifest = build_manifest(jobdir)
+        linked = []
+        try:
+            for (fname, entry) in src["manifest"].items():
+                name = rename(fname)
+                if (name in manifest or fname == src.get("batch")):
+                   continue
+                entry = dict(entry)
+                if ("stored" in entry):
+                   entry["stored"] = name + suffixes[entry["encoding"]]
+                target = os.path.join(jobdir, entry.get("stored", name))
+                os.link(os.path.join(srcdir, src["manifest"][fname].get("stored", fname)), target)
+                linked.append(target)
+                manifest[name] = entry
+        except OSError as e:
+            # Run the job instead
+            logging.warning("Cached result not linked; JID=%s  source=%s: %s" % (jobid, srcid, str(e)))
+            for target in linked:
+                os.unlink(target)
+            return None
+
+        (size, inodes) = disk_usage(jobdir)
+        doc = self.__owner(userid)
+        doc.update({ "slurmid" : -1, "status" : "NEW", "files" : [], "input" : input_fname,
+           "output" : output_fname, "bytes" : size, "inodes" : inodes })
+        with self.db.pipeline() as p:
+            self.store.create(jobid, doc, pipe=p)
+            self.store.transition(jobid, "NEW", { "status" : "DONE", "files" : list(manifest),
+               "manifest" : manifest, "cached" : srcid }, pipe=p)
+            self.add_usage(p, userid, size, inodes)
+            p.execute()
+
+        logging.info("Cached result linked; JID=%s  source=%s" % (jobid, srcid))
+        return ComputationalJob(jobid, -1, "DONE", list(manifest), manifest, output_fname)
+
+    def __owner(self, userid):
+        """Returns the fields that index a new job under its owner"""
+        if (userid is None):
+           return { }
+        return { "userid" : userid, "submitted" : time.time() }
+
+    def __write_environment(self, fh):
+        # The following is a temp hack as qchem interrogates $HOME
+        fh.write("export HOME=/home/ec2-user\n")
+        fh.write("export QC={0}\n".format(self.qc))
+        fh.write("export QCAUX={0}\n".format(self.qcaux))
+        fh.write("export QCSCRATCH={0}\n".format(self.qcscratch))
 
     def update_job_status(self, jobid, status):
-        self.__update_job_descriptor(jobid, [("status", status)])
+        self.store.transition(jobid, None, { "status" : status })
 
     def update_job_status_error(self, jobid, msg):
-        self.__update_job_descriptor(jobid,
-                [("status", "ERROR"), ("error", msg)])
+        self.store.transition(jobid, None, { "status" : "ERROR", "error" : msg })
 
     def update_job_files(self, jobid):
-        files = os.listdir(self.get_job_workdir(jobid))
-        self.__update_job_descriptor(jobid, [("files", files)])
-
-    def __update_job_descriptor(self, jobid, nvpairs):
-        jobkey = "job:%s" % jobid
-        with self.db.pipeline() as p:
-            while 1:
-                try:
-                    p.watch(jobkey)
-                    doc = json.loads(p.get(jobkey))
-                    for nvpair in nvpairs:
-                        doc[nvpair[0]] = nvpair[1]
-                    p.multi()
-                    p.set(jobkey, json.dumps(doc))
-                    p.execute()
-                    break
-                except WatchError:
-                    continue
+        jobdir = self.get_job_workdir(jobid)
+        self.store.update(jobid, { "files" : os.listdir(jobdir),
+           "manifest" : build_manifest(jobdir) })
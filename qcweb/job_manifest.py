@@ -0,0 +1,44 @@
+import os
+import hashlib
+
+
+def build_manifest(jobdir, previous = None):
+    """Returns the name, size and mtime of each regular file in jobdir as a
+    dictionary keyed by name.  Entries for files whose size and mtime are
+    unchanged since the previous manifest are reused, so their checksums
+    are kept."""
+    previous = previous or { }
+    manifest = { }
+    for entry in os.scandir(jobdir):
+        if (not entry.is_file(follow_symlinks=False)):
+           continue
+        stat = entry.stat(follow_symlinks=False)
+        old = previous.get(entry.name)
+        if (old is not None and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime):
+           manifest[entry.name] = old
+        else:
+           manifest[entry.name] = { "size" : stat.st_size, "mtime" : stat.st_mtime }
+    return manifest
+
+
+
+def file_checksum(fpath, chunk_size = 1024*1024):
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as fh:
+       chunk = fh.read(chunk_size)
+       while (chunk):
+           digest.update(chunk)
+           chunk = fh.read(chunk_size)
+    return digest.hexdigest()
+
+
+
+def add_checksums(jobdir, manifest):
+    """Fills in the sha256 of the files in the manifest that do not have
+    one yet.  Returns True if any were added."""
+    added = False
+    for (fname, entry) in manifest.items():
+        if ("sha256" not in entry):
+           entry["sha256"] = file_checksum(os.path.join(jobdir, fname))
+           added = True
+    return added
@@ -0,0 +1,365 @@
+import json
+import time
+import logging
+
+from redis.exceptions import WatchError
+
+
+# States a job does not leave once its workdir is complete
+final_states = ("DONE", "ERROR", "DELETED")
+
+
+# Moves a job to a new state in one round trip.  The change is applied only
+# if the job exists and, when ARGV[2] is not empty, is still in that state.
+# The pending and active job sets and the owner's status index are kept in
+# step and the new state is published for the job watchers.  A job
+# reaching a state with a retention period is scheduled for retirement, and
+# a finished job is listed in jobs:finished:<status> for the workdir GC.
+#
+#   KEYS[1]  job:<jobid>        ARGV[1]  jobid
+#   KEYS[2]  jobs:pending       ARGV[2]  expected status or ''
+#   KEYS[3]  jobs:active        ARGV[3]  retirement time or ''
+#   KEYS[4]  jobs:retire        ARGV[4:] field, value pairs
+#
+transition_script = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if (not status) or (ARGV[2] ~= '' and status ~= ARGV[2]) then
+   return 0
+end
+if #ARGV > 3 then
+   redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+end
+local new = redis.call('HGET', KEYS[1], 'status')
+if new ~= status then
+   redis.call('SREM', KEYS[2], ARGV[1])
+   if new == 'QUEUED' or new == 'RUNNING' then
+      redis.call('SADD', KEYS[3], ARGV[1])
+   else
+      redis.call('SREM', KEYS[3], ARGV[1])
+   end
+   if ARGV[3] ~= '' then
+      redis.call('ZADD', KEYS[4], ARGV[3], ARGV[1])
+   else
+      redis.call('ZREM', KEYS[4], ARGV[1])
+   end
+   local finished = redis.call('HGET', KEYS[1], 'finished')
+   redis.call('ZREM', 'jobs:finished:' .. status, ARGV[1])
+   if finished and (new == 'DONE' or new == 'ERROR' or new == 'DELETED') then
+      redis.call('ZADD', 'jobs:finished:' .. new, finished, ARGV[1])
+   end
+   local userid = redis.call('HGET', KEYS[1], 'userid')
+   if userid then
+      local score = redis.call('ZSCORE', 'jobs:user:' .. userid, ARGV[1])
+      if score then
+         redis.call('ZREM', 'jobs:user:' .. userid .. ':' .. status, ARGV[1])
+         redis.call('ZADD', 'jobs:user:' .. userid .. ':' .. new, score, ARGV[1])
+      end
+   end
+   redis.call('PUBLISH', 'jobstatus:' .. ARGV[1], new)
+end
+return 1
+"""
+
+# Removes the record of a job that has been archived, unless its state has
+# changed since it was read.  If ARGV[3] is set and the workdir of the job
+# has yet to be collected, the fields the workdir GC needs are kept in
+# retired:<jobid>.
+#
+#   KEYS[1]  job:<jobid>        ARGV[1]  jobid
+#   KEYS[2]  jobs:retire        ARGV[2]  archived status
+#                               ARGV[3]  keep GC fields or ''
+#
+retire_script = """
+local doc = redis.call('HMGET', KEYS[1], 'status', 'userid', 'bytes', 'inodes', 'array')
+if doc[1] ~= ARGV[2] then
+   return 0
+end
+if ARGV[3] ~= '' and redis.call('ZSCORE', 'jobs:finished:' .. doc[1], ARGV[1]) then
+   local names = { 'userid', 'bytes', 'inodes', 'array' }
+   local fields = { }
+   for i, name in ipairs(names) do
+      if doc[i + 1] then
+         table.insert(fields, name)
+         table.insert(fields, doc[i + 1])
+      end
+   end
+   redis.call('HSET', 'retired:' .. ARGV[1], unpack(fields))
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+if doc[2] then
+   redis.call('ZREM', 'jobs:user:' .. doc[2], ARGV[1])
+   redis.call('ZREM', 'jobs:user:' .. doc[2] .. ':' .. doc[1], ARGV[1])
+end
+return 1
+"""
+
+# Updates fields of an existing job without creating a record for an
+# unknown jobid
+update_script = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+   return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+
+
+# Fields stored JSON encoded, all others are strings
+json_fields = ("files", "manifest")
+
+
+
+class JobStore():
+    """Keeps job records as redis hashes under job:<jobid>.  The file list
+    and manifest are stored as JSON encoded fields, all other fields are
+    strings.
+
+    Jobs with a userid are also indexed in sorted sets scored by submit
+    time: jobs:user:<userid> holds all of the user's jobs and
+    jobs:user:<userid>:<status> those currently in each state.
+
+    Jobs that finish are kept for the retention period of their final
+    state, given in seconds, and then moved to the archive by retire.
+    Records not found in redis are looked up in the archive.  Without an
+    archive, the owner and size of a retired job whose workdir is still to
+    be collected are kept in retired:<jobid> until it is."""
+
+    def __init__(self, db, retention = { }, archive = None, collected = ()):
+        self.db = db
+        self.retention = retention
+        self.archive = archive
+        # Final states whose workdirs the workdir GC collects
+        self.collected = collected
+        self.transition_script = db.register_script(transition_script)
+        self.retire_script = db.register_script(retire_script)
+        self.update_script = db.register_script(update_script)
+
+
+    def create(self, jobid, fields, pipe = None):
+        """Writes a new job record.  Pending jobs are added to jobs:pending."""
+        p = pipe if pipe is not None else self.db.pipeline()
+        p.hset(self.key(jobid), mapping=self.encode(fields))
+        if (fields.get("status") == "PENDING" and "array" not in fields):
+           p.sadd("jobs:pending", jobid)
+        if ("userid" in fields):
+           userid = fields["userid"]
+           score  = fields["submitted"]
+           p.zadd(self.user_key(userid), { jobid : score })
+           p.zadd(self.user_key(userid, fields["status"]), { jobid : score })
+        if (pipe is None):
+           p.execute()
+
+
+    def get(self, jobid, userid = None):
+        """Returns the job record, or None if there is no such job or, when
+        a userid is given, the job belongs to someone else"""
+        return self.get_many([jobid], userid)[0]
+
+
+    def get_many(self, jobids, userid = None):
+        with self.db.pipeline(transaction=False) as p:
+            for jobid in jobids:
+                p.hgetall(self.key(jobid))
+                if (userid is not None):
+                   p.zscore(self.user_key(userid), jobid)
+            results = p.execute()
+
+        if (userid is None):
+           (docs, owned) = (results, [True] * len(jobids))
+        else:
+           # Records written before jobs were indexed by user have no owner
+           docs  = results[0::2]
+           owned = [score is not None or "userid" not in doc
+                       for (doc, score) in zip(docs, results[1::2])]
+        docs = [self.decode(doc) for doc in docs]
+
+        missing = [jobid for (jobid, doc) in zip(jobids, docs) if doc is None]
+        if (missing and self.archive is not None):
+           archived = self.archive.get_many(missing)
+           for (i, jobid) in enumerate(jobids):
+               doc = archived.get(jobid)
+               if (doc is not None):
+                  docs[i] = doc
+                  owned[i] = userid is None or doc.get("userid", userid) == userid
+
+        return [doc if ok else None for (doc, ok) in zip(docs, owned)]
+
+
+    def owns(self, userid, jobid):
+        return self.db.zscore(self.user_key(userid), jobid) is not None
+
+
+    def user_jobs(self, userid, statuses = None, cursor = None, count = 50):
+        """Returns up to count of the user's jobs, newest first, as a list of
+        (jobid, submit time) pairs together with the cursor for the next
+        page, or None if there are no more.  A cursor has the form
+        <submit time>:<jobid> and identifies the last job returned."""
+        keys = [self.user_key(userid, status) for status in statuses] \
+                  if statuses else [self.user_key(userid)]
+
+        entries = []
+        for key in keys:
+            entries.extend(self.__page(key, cursor, count + 1))
+        # Ties on the submit time are ordered as ZREVRANGEBYSCORE does
+        entries.sort(key=lambda e: (e[1], e[0]), reverse=True)
+
+        if (len(entries) <= count):
+           return (entries, None)
+        entries = entries[:count]
+        return (entries, "%r:%s" % (entries[-1][1], entries[-1][0]))
+
+
+    def __page(self, key, cursor, count):
+        """Reads count entries from the sorted set that follow the cursor"""
+        if (cursor is None):
+           return self.db.zrevrangebyscore(key, "+inf", "-inf",
+              start=0, num=count, withscores=True)
+
+        (score, last) = cursor.split(":", 1)
+        score = float(score)
+        entries = []
+        start = 0
+        while (len(entries) < count):
+            # Jobs submitted at the same time as the cursor are returned in
+            # reverse order of jobid, skip those already seen
+            batch = self.db.zrevrangebyscore(key, score, "-inf",
+               start=start, num=count, withscores=True)
+            entries.extend([e for e in batch if e[1] != score or e[0] < last])
+            if (len(batch) < count):
+               break
+            start += count
+        return entries[:count]
+
+
+    def update(self, jobid, fields):
+        return bool(self.update_script(keys=[self.key(jobid)],
+           args=self.flatten(fields)))
+
+
+    def transition(self, jobid, status, fields, pipe = None):
+        """Applies the fields if the job is in the given status, or in any
+        status if status is None.  Returns False if the job had moved on;
+        when a pipeline is given the result is returned by its execute."""
+        keys = [self.key(jobid), "jobs:pending", "jobs:active", "jobs:retire"]
+        retire = ""
+        if (fields.get("status") in final_states):
+           fields = dict(fields, finished=time.time())
+           if (self.retention.get(fields["status"])):
+              retire = repr(fields["finished"] + self.retention[fields["status"]])
+        args = [jobid, status or "", retire] + self.flatten(fields)
+        if (pipe is not None):
+           return self.transition_script(keys=keys, args=args, client=pipe)
+        return bool(self.transition_script(keys=keys, args=args))
+
+
+    def retire(self, batch = 500):
+        """Archives and removes the records of jobs whose retention period
+        has passed.  Returns the number of jobs retired."""
+        retired = 0
+        while True:
+            jobids = self.db.zrangebyscore("jobs:retire", "-inf", time.time(),
+               start=0, num=batch)
+            if (not jobids):
+               break
+
+            with self.db.pipeline(transaction=False) as p:
+                for jobid in jobids:
+                    p.hgetall(self.key(jobid))
+                docs = [self.decode(doc) for doc in p.execute()]
+
+            # Records are archived before they are removed so that a job can
+            # always be found in one place or the other
+            if (self.archive is not None):
+               self.archive.put([(jobid, doc) for (jobid, doc) in zip(jobids, docs)
+                                   if doc is not None])
+
+            with self.db.pipeline(transaction=False) as p:
+                for (jobid, doc) in zip(jobids, docs):
+                    if (doc is None):
+                       p.zrem("jobs:retire", jobid)
+                    else:
+                       self.retire_script(keys=[self.key(jobid), "jobs:retire"],
+                          args=[jobid, doc["status"], "1" if self.archive is None and
+                                doc["status"] in self.collected else ""], client=p)
+                retired += sum(p.execute())
+
+            if (len(jobids) < batch):
+               break
+
+        return retired
+
+
+    def key(self, jobid):
+        return "job:%s" % jobid
+
+
+    def user_key(self, userid, status = None):
+        if (status is None):
+           return "jobs:user:%s" % userid
+        return "jobs:user:%s:%s" % (userid, status)
+
+
+    def flatten(self, fields):
+        args = []
+        for (name, value) in self.encode(fields).items():
+            args.extend([name, value])
+        return args
+
+
+    def encode(self, fields):
+        doc = { }
+        for (name, value) in fields.items():
+            doc[name] = json.dumps(value) if name in json_fields else str(value)
+        return doc
+
+
+    def decode(self, doc):
+        if (not doc):
+           return None
+        doc["files"] = json.loads(doc.get("files", "[]"))
+        if ("manifest" in doc):
+           doc["manifest"] = json.loads(doc["manifest"])
+        return doc
+
+
+    def migrate(self):
+        """Converts job records stored as JSON strings to hashes in place,
+        makes sure queued and running jobs are in the active job set and
+        that finished jobs are scheduled for retirement and GC"""
+        converted = 0
+        for jobkey in self.db.scan_iter(match="job:*", count=1000):
+            with self.db.pipeline() as p:
+                try:
+                    p.watch(jobkey)
+                    if (p.type(jobkey) == "string"):
+                       doc = json.loads(p.get(jobkey))
+                       doc.pop("jobid", None)
+                       p.multi()
+                       p.delete(jobkey)
+                       p.hset(jobkey, mapping=self.encode(doc))
+                       p.execute()
+                       converted += 1
+                    else:
+                       p.unwatch()
+                except WatchError:
+                    logging.warning("Job %s changed during migration" % jobkey)
+                    continue
+
+            doc = self.db.hmget(jobkey, "status", "slurmid", "finished")
+            if ((doc[0] == "QUEUED" or doc[0] == "RUNNING") and doc[1] != "-1"):
+               self.db.sadd("jobs:active", jobkey[4:])
+            elif (doc[0] in final_states and doc[2] is None):
+               # Jobs that finished before their finish time was recorded are
+               # treated as finishing now
+               now = time.time()
+               with self.db.pipeline() as p:
+                   p.hset(jobkey, "finished", now)
+                   p.zadd("jobs:finished:%s" % doc[0], { jobkey[4:] : now })
+                   if (self.retention.get(doc[0])):
+                      p.zadd("jobs:retire", { jobkey[4:] : now + self.retention[doc[0]] })
+                   p.execute()
+
+        if (converted > 0):
+           logging.info("Converted %d job records to hashes" % converted)
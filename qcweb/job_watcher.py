@@ -0,0 +1,46 @@
+import logging
+import tornado.gen
+import redis.asyncio
+
+
+class JobWatcher():
+    """Listens for job status changes published by the JobManager on the
+    jobstatus:<jobid> channels and passes them to the queues of the
+    requests watching those jobs"""
+
+    def __init__(self, config):
+        redis_host = config.get("redis", "host")
+        redis_port = config.get("redis", "port")
+        self.db = redis.asyncio.StrictRedis(host=redis_host, port=redis_port,
+           db=0, decode_responses=True)
+        self.watchers = { }
+
+    def watch(self, jobid, queue):
+        self.watchers.setdefault(jobid, set()).add(queue)
+
+    def unwatch(self, jobid, queue):
+        queues = self.watchers.get(jobid)
+        if (queues is not None):
+           queues.discard(queue)
+           if (not queues):
+              del self.watchers[jobid]
+
+    async def run(self):
+        while True:
+            try:
+                pubsub = self.db.pubsub()
+                await pubsub.psubscribe("jobstatus:*")
+                logging.info("Job watcher subscribed to status updates")
+
+                async for message in pubsub.listen():
+                    if (message["type"] != "pmessage"):
+                       continue
+                    jobid = message["channel"].split(":", 1)[1]
+                    for queue in self.watchers.get(jobid, ()):
+                        queue.put_nowait((jobid, message["data"]))
+
+            except Exception as e:
+                # Watching requests re-read the job records periodically so
+                # nothing is lost while we reconnect.
+                logging.error("Job watcher connection lost: %s" % str(e))
+                await tornado.gen.sleep(1)
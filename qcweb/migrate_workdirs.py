@@ -0,0 +1,93 @@
+#
+#  Moves job workdirs created in the flat layout to the sharded layout
+#  while qcweb keeps running:
+#
+#     python3 migrate_workdirs.py qcloud.cfg
+#
+#  Each workdir is renamed into place, which is atomic on the same file
+#  system, and a symlink is left at the old path for batch scripts and
+#  running jobs that refer to it.  qcweb looks for a job at the sharded path
+#  first so it finds the moved workdir straight away.  Once the jobs that
+#  were queued or running during the migration have finished, run again with
+#  --remove-links to remove the symlinks.
+#
+
+import os
+import re
+import sys
+import redis
+import logging
+import argparse
+import configparser
+
+from workdir_layout import job_path
+
+
+jobid_re = re.compile("^[a-f0-9]{32}$")
+
+
+
+def migrate(workdir, limit):
+    moved = 0
+    for entry in os.scandir(workdir):
+        if (not jobid_re.match(entry.name) or not entry.is_dir(follow_symlinks=False)):
+           continue
+
+        target = job_path(workdir, entry.name, "sharded")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(entry.path, target)
+        os.symlink(os.path.relpath(target, workdir), entry.path)
+
+        moved += 1
+        if (moved % 1000 == 0):
+           logging.info("Moved %d workdirs" % moved)
+        if (limit and moved >= limit):
+           break
+    return moved
+
+
+
+def remove_links(workdir, db):
+    """Removes the symlinks of jobs that are no longer pending or active"""
+    busy = db.smembers("jobs:active") | db.smembers("jobs:pending")
+    removed = 0
+    for entry in os.scandir(workdir):
+        if (jobid_re.match(entry.name) and entry.is_symlink() and entry.name not in busy):
+           os.unlink(entry.path)
+           removed += 1
+    return removed
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move job workdirs to the sharded layout")
+    parser.add_argument("config")
+    parser.add_argument("--limit", default=0, type=int,
+       help="stop after moving this many workdirs")
+    parser.add_argument("--remove-links", action="store_true",
+       help="remove the symlinks left by an earlier run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+       format='%(asctime)s - %(levelname)-8s - %(message)s',
+       datefmt='%d/%m/%Y %Hh%Mm%Ss')
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    workdir = config.get("queue", "workdir")
+
+    if (config.get("queue", "workdir_layout", fallback="flat") != "sharded"):
+       logging.error("Set [queue] workdir_layout = sharded before migrating")
+       sys.exit(1)
+
+    if (args.remove_links):
+       db = redis.StrictRedis(host=config.get("redis", "host"),
+          port=config.get("redis", "port"), db=0, decode_responses=True)
+       logging.info("Removed %d symlinks" % remove_links(workdir, db))
+    else:
+       logging.info("Moved %d workdirs" % migrate(workdir, args.limit))
+
+
+
+if __name__ == "__main__":
+    main()
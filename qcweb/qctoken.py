@@ -0,0 +1,128 @@
+#
+#  HS256 JSON web tokens signed and verified with a keyring.  The same file
+#  is used by qcauth, which issues tokens, and qcweb, which verifies them
+#  in-process; keep the two copies identical.
+#
+#  The keyring holds the active key, used to sign new tokens, and any
+#  retiring keys, which are still accepted until the tokens signed with
+#  them expire.  Keys are identified by the kid header of the token.
+#  Tokens without a kid were signed with [authentication] jwt_code before
+#  keyrings were introduced and are checked against that key.
+#
+
+import hmac
+import json
+import time
+import base64
+import hashlib
+
+
+class TokenError(Exception):
+    pass
+
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+
+class Keyring():
+    def __init__(self, keys, active):
+        """keys maps each kid to its secret, active is the kid of the key
+        used for signing"""
+        if (active not in keys):
+           raise Exception("Unknown active JWT key " + active)
+        self.active = active
+        # Keyed hashes are set up once and copied for each token
+        self.macs = { }
+        for (kid, secret) in keys.items():
+            self.macs[kid] = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+
+
+    def sign(self, kid, data):
+        mac = self.macs[kid].copy()
+        mac.update(data)
+        return mac.digest()
+
+
+
+def keyring_from_config(config):
+    """Builds the keyring from the [jwt_keys] section, which lists each key
+    as kid = secret, and [authentication] jwt_kid, the kid of the active key.
+    The jwt_code key has the kid "default" and is active unless another is
+    set."""
+    keys = { "default" : config.get("authentication", "jwt_code") }
+    if (config.has_section("jwt_keys")):
+       for (kid, secret) in config.items("jwt_keys"):
+           keys[kid] = secret
+    return Keyring(keys, config.get("authentication", "jwt_kid", fallback="default"))
+
+
+
+def encode(claims, keyring):
+    header = { "alg" : "HS256", "typ" : "JWT", "kid" : keyring.active }
+    signing_input = b'.'.join([
+       b64encode(json.dumps(header, separators=(',', ':')).encode()),
+       b64encode(json.dumps(claims, separators=(',', ':')).encode())])
+    signature = keyring.sign(keyring.active, signing_input)
+    return (signing_input + b'.' + b64encode(signature)).decode('ascii')
+
+
+
+def decode(token, keyring, now = None):
+    """Verifies the signature and expiry of the token and returns its
+    claims.  Failures raise a TokenError with the messages clients already
+    recognise."""
+    try:
+        token = token.encode('ascii')
+        (signing_input, signature) = token.rsplit(b'.', 1)
+        (header, payload) = signing_input.split(b'.')
+        header = json.loads(b64decode(header))
+        signature = b64decode(signature)
+    except (ValueError, UnicodeError):
+        raise TokenError("JWT failed validation")
+    if (not isinstance(header, dict)):
+       raise TokenError("JWT failed validation")
+
+    kid = header.get("kid", "default")
+    if (header.get("alg") != "HS256" or kid not in keyring.macs):
+       raise TokenError("JWT invalid token")
+    if (not hmac.compare_digest(keyring.sign(kid, signing_input), signature)):
+       raise TokenError("JWT failed validation")
+
+    try:
+        claims = json.loads(b64decode(payload))
+    except (ValueError, UnicodeError):
+        raise TokenError("JWT failed validation")
+    if (not isinstance(claims, dict)):
+       raise TokenError("JWT invalid token")
+
+    exp = claims.get("exp")
+    if (exp is not None):
+       if (not isinstance(exp, (int, float))):
+          raise TokenError("JWT invalid token")
+       if (exp <= (now or time.time())):
+          raise TokenError("JWT signature expired")
+    return claims
+
+
+
+def claims(token):
+    """Returns the claims of a token without verifying it"""
+    try:
+        payload = token.encode('ascii').split(b'.')[1]
+        claims = json.loads(b64decode(payload))
+        return claims if isinstance(claims, dict) else { }
+    except (ValueError, IndexError, UnicodeError):
+        return { }
+
+
+
+def expiry(token):
+    """Returns the exp claim of a token without verifying it"""
+    return claims(token).get("exp")
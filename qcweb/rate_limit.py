@@ -0,0 +1,102 @@
+#
+#  Token bucket rate limits shared by all qcauth and qcweb processes.  The
+#  same file is used by both services; keep the two copies identical.
+#
+#  Limits are set in the [ratelimit] section as name = requests/seconds,
+#  which allows bursts of up to that many requests and refills at that
+#  average rate.  Each bucket is a redis hash updated by a Lua script, so
+#  a request is admitted or refused atomically however many processes
+#  share the limit.  A process also refuses requests locally while a
+#  bucket it has seen refused has not yet had time to refill, without
+#  going to redis.
+#
+#  Requests passed on by a proxy listed in trusted_proxies, such as qcweb
+#  passing /register to qcauth or nginx in front of qcweb, are limited by
+#  the X-Forwarded-For address.
+#
+
+import time
+import logging
+import collections
+
+
+class RateLimiter():
+    # KEYS: bucket
+    # ARGV: rate (tokens per second), burst, now, cost
+    # Returns 0 if the request is admitted, otherwise the milliseconds
+    # until enough tokens will be available
+    bucket_script = """
+        local rate  = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now   = tonumber(ARGV[3])
+        local cost  = tonumber(ARGV[4])
+
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or burst
+        local ts     = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+
+        local wait = 0
+        if tokens >= cost then
+           tokens = tokens - cost
+        else
+           wait = math.ceil((cost - tokens) / rate * 1000)
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+        return wait
+    """
+
+    # Refused buckets remembered by each process
+    local_size = 10000
+
+    def __init__(self, db, config):
+        self.db = db
+        self.enabled = config.getboolean("ratelimit", "enabled", fallback=False)
+        self.trusted_proxies = set(config.get("ratelimit", "trusted_proxies", fallback="").split())
+        self.limits = { }
+        if (config.has_section("ratelimit")):
+           for (name, value) in config.items("ratelimit"):
+               if (name not in ("enabled", "trusted_proxies")):
+                  (requests, seconds) = value.split("/")
+                  self.limits[name] = (float(requests) / float(seconds), float(requests))
+        if (self.enabled and not self.trusted_proxies and
+           any(name.endswith("_ip") for name in self.limits)):
+           logging.warning("No trusted_proxies set, clients behind a proxy share its "
+              "per address rate limits")
+        self.refused = collections.OrderedDict()
+        self.bucket_script = db.register_script(RateLimiter.bucket_script)
+
+
+    def client_address(self, request):
+        forwarded = request.headers.get("X-Forwarded-For")
+        if (forwarded and request.remote_ip in self.trusted_proxies):
+           return forwarded.split(",")[-1].strip()
+        return request.remote_ip
+
+
+    def check(self, name, ident, cost = 1):
+        """Takes cost tokens from the bucket of ident under the named limit.
+        Returns 0 if the request is allowed, otherwise the seconds to wait
+        before retrying."""
+        if (not self.enabled or name not in self.limits or ident is None):
+           return 0
+
+        key = "ratelimit:%s:%s" % (name, ident)
+        now = time.time()
+        until = self.refused.get(key)
+        if (until is not None):
+           if (until > now):
+              return until - now
+           del self.refused[key]
+
+        # A batch larger than the burst takes the whole bucket
+        (rate, burst) = self.limits[name]
+        cost = min(cost, burst)
+        wait = self.bucket_script(keys=[key], args=[rate, burst, repr(now), cost]) / 1000.0
+        if (wait > 0):
+           self.refused[key] = now + wait
+           while (len(self.refused) > self.local_size):
+              self.refused.popitem(last=False)
+        return wait
@@ -0,0 +1,100 @@
+import os
+import re
+import hashlib
+
+
+# Written at the end of every Q-Chem run that completes normally
+success_marker = b"Thank you very much for using Q-Chem"
+
+
+
+# Sections made of keyword value lines, where the keywords are not case
+# sensitive
+keyword_sections = ("$rem", "$rem_frgm")
+
+
+
+def normalize(text):
+    """Returns the input with comments, blank lines and extra spacing
+    removed, and with section names and keywords in lower case.  Values
+    keep their case, as file names and the contents of other sections may
+    depend on it."""
+    lines = []
+    section = None
+    for line in text.splitlines():
+        line = " ".join(line.split("!", 1)[0].split())
+        if (not line):
+           continue
+        if (line.startswith("$")):
+           (name, space, rest) = line.partition(" ")
+           section = name.lower()
+           line = section + space + rest
+        elif (section in keyword_sections):
+           match = re.match(r'([^\s=]+)(.*)', line)
+           line = match.group(1).lower() + match.group(2)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+
+def succeeded(fpath, tail = 64*1024):
+    """Returns True if the Q-Chem output ends with the success marker"""
+    try:
+        with open(fpath, 'rb') as fh:
+           fh.seek(max(os.fstat(fh.fileno()).st_size - tail, 0))
+           return success_marker in fh.read()
+    except OSError:
+        return False
+
+
+
+class ResultCache():
+    """Maps a hash of the inputs of a job to a job with the same inputs that
+    finished successfully, so that resubmissions can link to its files
+    rather than run again.  The hash covers the normalized Q-Chem input, the
+    $slurm section less the job name and the Q-Chem installation.  Entries
+    expire ttl seconds after they were last used, and are dropped sooner if
+    the job they point to is no longer available."""
+
+    # Only removes an entry that still points to the given job
+    forget_script = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+           return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, db, qc_version, ttl):
+        self.db = db
+        self.qc_version = qc_version
+        self.ttl = ttl
+        self.forget_script = db.register_script(ResultCache.forget_script)
+
+
+    def key(self, slurm_input, qchem_input):
+        # The job name only sets the names of the files, and the $slurm
+        # section of a single job is passed as part of its input
+        slurm_input = re.sub(r'--job-name[\s=]+\S+', '', slurm_input)
+        qchem_input = re.sub(r'(?i)\$slurm[\s\S]*?\$end', '', qchem_input)
+        digest = hashlib.sha256()
+        for part in (self.qc_version, normalize(slurm_input), normalize(qchem_input)):
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+
+    def lookup(self, key):
+        """Returns the jobid of the cached result, if there is one"""
+        with self.db.pipeline(transaction=False) as p:
+            p.get("resultcache:%s" % key)
+            if (self.ttl > 0):
+               p.expire("resultcache:%s" % key, self.ttl)
+            return p.execute()[0]
+
+
+    def add(self, key, jobid, pipe):
+        pipe.set("resultcache:%s" % key, jobid, ex=self.ttl if self.ttl > 0 else None)
+
+
+    def forget(self, key, jobid):
+        self.forget_script(keys=["resultcache:%s" % key], args=[jobid])
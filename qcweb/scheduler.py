@@ -0,0 +1,338 @@
+import os
+import re
+import json
+import logging
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+from slurm_broker import BrokerClient
+
+
+# SLURM job states that mean the job has left the queue
+final_states = ("COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL",
+   "PREEMPTED", "BOOT_FAIL", "DEADLINE", "OUT_OF_MEMORY")
+
+# squeue short codes for the job states reported by slurmrestd
+state_codes = { "PENDING" : "PD", "RUNNING" : "R", "COMPLETING" : "CG",
+   "CONFIGURING" : "CF", "SUSPENDED" : "S", "REQUEUED" : "RQ",
+   "RESIZING" : "RS", "SIGNALING" : "SI", "STAGE_OUT" : "SO",
+   "STOPPED" : "ST", "REQUEUE_HOLD" : "RH", "REQUEUE_FED" : "RF",
+   "RESV_DEL_HOLD" : "RD", "SPECIAL_EXIT" : "SE" }
+
+
+
+class SchedulerError(Exception):
+    pass
+
+
+
+class Scheduler():
+    """Interface to the batch system that runs the jobs"""
+
+    def submit(self, jobdir, batch_fname):
+        """Submits the batch file in jobdir and returns the scheduler id"""
+        raise NotImplementedError
+
+    def cancel(self, slurmid):
+        raise NotImplementedError
+
+    def info(self, slurmid):
+        """Returns a printable description of the job"""
+        raise NotImplementedError
+
+    def states(self):
+        """Returns a dictionary of the squeue state code of every job still
+        known to the scheduler, keyed by scheduler id, or None if the state
+        could not be determined"""
+        raise NotImplementedError
+
+
+
+class SlurmCLI(Scheduler):
+    """Runs the SLURM command line tools, either directly or through the
+    qcbroker daemon on the host"""
+
+    def __init__(self, slurm_path, broker, timeout):
+        self.slurm_path = slurm_path
+        self.timeout = timeout
+        self.broker = BrokerClient(broker, timeout) if broker else None
+
+    def command(self, *argv):
+        """Runs a SLURM command and returns its exit status and output"""
+        argv = list(argv)
+        if (self.broker is not None):
+           return self.broker.run(argv)
+
+        argv[0] = os.path.join(self.slurm_path, argv[0])
+        try:
+            proc = subprocess.run(argv, stdout=subprocess.PIPE,
+               stderr=subprocess.STDOUT, universal_newlines=True,
+               timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return (-1, "%s timed out" % argv[0])
+        return (proc.returncode, proc.stdout.strip())
+
+    def submit(self, jobdir, batch_fname):
+        (status, output) = self.command("sbatch", "%s/%s" % (jobdir, batch_fname))
+        match = re.match(r"Submitted batch job (\d+)", output)
+        if (not bool(match)):
+           raise SchedulerError("Failed to determine SLURM jobid from output %s" % output)
+        return match.group(1)
+
+    def cancel(self, slurmid):
+        self.command("scancel", str(slurmid))
+
+    def info(self, slurmid):
+        (status, output) = self.command("scontrol", "show", "job", str(slurmid))
+        return output
+
+    def states(self):
+        # -r lists each array task separately as <arrayid>_<task>
+        (status, output) = self.command("squeue", "-h", "-r", "-o", "%i:%t")
+        if (status != 0):
+           logging.error("squeue failed: %s" % output)
+           return None
+
+        states = { }
+        for line in output.splitlines():
+            tokens = line.strip().split(":")
+            if (len(tokens) == 2):
+               states[tokens[0]] = tokens[1]
+        return states
+
+
+
+def number(value):
+    """Unwraps the {set, infinite, number} objects used by newer versions of
+    the slurmrestd API"""
+    if (isinstance(value, dict)):
+       return value.get("number") if value.get("set", True) else None
+    return value
+
+
+
+def array_tasks(value):
+    """Expands an array task string such as "0-99%10" or "1,3,8-12:2" into
+    the task ids it lists"""
+    tasks = []
+    value = value.split("%", 1)[0]
+    for field in value.split(","):
+        field = field.strip()
+        if (not field):
+           continue
+        (field, _, step) = field.partition(":")
+        (first, _, last) = field.partition("-")
+        tasks.extend(range(int(first), int(last or first) + 1, int(step or 1)))
+    return tasks
+
+
+
+def time_limit(value):
+    """Converts an sbatch --time value to minutes"""
+    days = 0
+    if ("-" in value):
+       (days, value) = value.split("-", 1)
+       days = int(days)
+       fields = [int(f) for f in value.split(":")] + [0, 0]
+       (hours, minutes, seconds) = fields[0:3]
+    else:
+       fields = [int(f) for f in value.split(":")]
+       if (len(fields) == 3):
+          (hours, minutes, seconds) = fields
+       elif (len(fields) == 2):
+          (hours, minutes, seconds) = (0, fields[0], fields[1])
+       else:
+          (hours, minutes, seconds) = (0, fields[0], 0)
+    return days*1440 + hours*60 + minutes + (1 if seconds > 0 else 0)
+
+
+
+def memory(value):
+    """Converts an sbatch --mem value to megabytes"""
+    units = { "K" : 1.0/1024, "M" : 1, "G" : 1024, "T" : 1024*1024 }
+    match = re.match(r'^(\d+)([KMGT]?)B?$', value.upper())
+    if (not match):
+       raise SchedulerError("Invalid memory specification " + value)
+    return int(int(match.group(1)) * units.get(match.group(2) or "M"))
+
+
+
+class SlurmREST(Scheduler):
+    """Talks to slurmrestd over persistent HTTP connections, one per thread"""
+
+    # sbatch options understood in #SBATCH lines, with the name of the
+    # matching job property and a conversion function
+    options = {
+       "job-name"        : ("name", str),
+       "partition"       : ("partition", str),
+       "nodes"           : ("nodes", str),
+       "ntasks"          : ("tasks", int),
+       "cpus-per-task"   : ("cpus_per_task", int),
+       "mem"             : ("memory_per_node", memory),
+       "mem-per-cpu"     : ("memory_per_cpu", memory),
+       "time"            : ("time_limit", time_limit),
+       "chdir"           : ("current_working_directory", str),
+       "output"          : ("standard_output", str),
+       "error"           : ("standard_error", str),
+       "array"           : ("array", str),
+       "account"         : ("account", str),
+       "qos"             : ("qos", str),
+       "exclusive"       : ("exclusive", lambda v: "exclusive"),
+    }
+
+    short_options = { "J" : "job-name", "p" : "partition", "N" : "nodes",
+       "n" : "ntasks", "c" : "cpus-per-task", "t" : "time", "D" : "chdir",
+       "o" : "output", "e" : "error", "a" : "array", "A" : "account",
+       "q" : "qos" }
+
+    def __init__(self, url, user, token, version, timeout):
+        url = urllib.parse.urlparse(url)
+        self.host = url.hostname
+        self.port = url.port or 6820
+        self.prefix = "/slurm/%s" % version
+        self.timeout = timeout
+        self.headers = { "X-SLURM-USER-NAME"  : user,
+                         "X-SLURM-USER-TOKEN" : token,
+                         "Content-Type"       : "application/json",
+                         "Accept"             : "application/json" }
+        self.local = threading.local()
+
+
+    def request(self, method, path, body = None):
+        """Returns the decoded JSON response to the request"""
+        if (body is not None):
+           body = json.dumps(body)
+
+        for attempt in (1, 2):
+            conn = self.__connection()
+            try:
+                conn.request(method, self.prefix + path, body, self.headers)
+                res  = conn.getresponse()
+                data = res.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # slurmrestd closed the idle connection, reconnect once
+                self.__close()
+                if (attempt == 2):
+                   raise
+            except http.client.HTTPException as e:
+                self.__close()
+                raise SchedulerError("slurmrestd %s %s failed: %s" % (method, path, repr(e)))
+            except BaseException:
+                # A connection left waiting for a response, after a timeout
+                # say, cannot send another request
+                self.__close()
+                raise
+
+        doc = json.loads(data) if data else { }
+        errors = [e for e in doc.get("errors", []) if e]
+        if (res.status >= 400 or errors):
+           msg = errors[0].get("description", errors[0].get("error")) if errors else res.reason
+           raise SchedulerError("slurmrestd %s %s failed: %s" % (method, path, msg))
+        return doc
+
+
+    def job_properties(self, script, jobdir):
+        job = { "current_working_directory" : jobdir,
+                "environment" : [ "PATH=/bin:/usr/bin:/usr/local/bin" ] }
+
+        for line in script.splitlines():
+            if (not line.startswith("#SBATCH")):
+               continue
+            for arg in re.findall(r'(--?[\w-]+)(?:[\s=]+([^-\s]\S*))?', line[7:]):
+                (flag, value) = arg
+                name = flag.lstrip("-")
+                if (not flag.startswith("--")):
+                   name = self.short_options.get(name, name)
+                if (name not in self.options):
+                   logging.warning("Ignoring unsupported sbatch option %s" % flag)
+                   continue
+                (prop, convert) = self.options[name]
+                job[prop] = convert(value)
+
+        return job
+
+
+    def submit(self, jobdir, batch_fname):
+        with open(os.path.join(jobdir, batch_fname)) as fh:
+           script = fh.read()
+        doc = self.request("POST", "/job/submit",
+           { "script" : script, "job" : self.job_properties(script, jobdir) })
+        return str(doc["job_id"])
+
+    def cancel(self, slurmid):
+        self.request("DELETE", "/job/%s" % slurmid)
+
+    def info(self, slurmid):
+        doc = self.request("GET", "/job/%s" % slurmid)
+        return json.dumps(doc.get("jobs", []), indent=2)
+
+    def states(self):
+        try:
+            doc = self.request("GET", "/jobs")
+        except (OSError, SchedulerError, ValueError) as e:
+            logging.error("slurmrestd job query failed: %s" % str(e))
+            return None
+
+        states = { }
+        for job in doc.get("jobs", []):
+            state = job.get("job_state")
+            if (isinstance(state, list)):
+               state = state[0] if state else None
+            if (state is None or state in final_states):
+               continue
+
+            code  = state_codes.get(state, "PD")
+            jobid = str(number(job.get("job_id")))
+            arrayid = number(job.get("array_job_id"))
+            task  = number(job.get("array_task_id"))
+            if (task is not None):
+               states["%s_%s" % (arrayid, task)] = code
+            elif (arrayid and job.get("array_task_string")):
+               # The tasks of an array that have not started are listed
+               # together in a single record, like squeue without -r
+               try:
+                   for task in array_tasks(job["array_task_string"]):
+                       states["%s_%d" % (arrayid, task)] = code
+               except ValueError:
+                   logging.error("Unrecognised array tasks %s of job %s" %
+                      (job["array_task_string"], jobid))
+                   return None
+            else:
+               states[jobid] = code
+        return states
+
+
+    def __connection(self):
+        conn = getattr(self.local, "conn", None)
+        if (conn is None):
+           conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+           self.local.conn = conn
+        return conn
+
+    def __close(self):
+        conn = getattr(self.local, "conn", None)
+        if (conn is not None):
+           conn.close()
+           self.local.conn = None
+
+
+
+def create_scheduler(config, slurm_path):
+    """Returns the scheduler selected by [queue] scheduler, either "cli"
+    (the default) or "rest" for slurmrestd"""
+    timeout = config.getfloat("queue", "broker_timeout", fallback=60)
+    backend = config.get("queue", "scheduler", fallback="cli")
+
+    if (backend == "rest"):
+       url     = config.get("slurmrestd", "url")
+       user    = config.get("slurmrestd", "user")
+       token   = config.get("slurmrestd", "token")
+       version = config.get("slurmrestd", "version", fallback="v0.0.39")
+       logging.info("Using slurmrestd scheduler at %s" % url)
+       return SlurmREST(url, user, token, version, timeout)
+
+    broker = config.get("queue", "broker", fallback=None)
+    return SlurmCLI(slurm_path, broker, timeout)
@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import http.server
+
+from scheduler import SlurmREST, SchedulerError, array_tasks, time_limit, memory
+
+
+class FakeSlurmrestd(http.server.BaseHTTPRequestHandler):
+    """Minimal stand-in for slurmrestd that keeps its jobs in memory"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, doc):
+        data = json.dumps(doc).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        server.requests.append((self.command, self.path, self.headers))
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server.next_id += 1
+        server.jobs[server.next_id] = body
+        self.reply(200, { "job_id" : server.next_id, "errors" : [] })
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.command, self.path, self.headers))
+        if (server.stall > 0):
+           # Answer nothing until the client has given up
+           server.stall -= 1
+           time.sleep(0.5)
+           self.close_connection = True
+           return
+        if (self.path == "/slurm/v0.0.39/jobs"):
+           jobs = [ { "job_id" : 1, "job_state" : ["RUNNING"] },
+                    { "job_id" : 2, "job_state" : "PENDING" },
+                    { "job_id" : 3, "job_state" : ["COMPLETED"] },
+                    { "job_id" : { "set" : True, "number" : 9 },
+                      "array_job_id" : { "set" : True, "number" : 8 },
+                      "array_task_id" : { "set" : True, "number" : 1 },
+                      "job_state" : ["COMPLETING"] },
+                    { "job_id" : 8, "array_job_id" : { "set" : True, "number" : 8 },
+                      "array_task_id" : { "set" : False, "number" : 0 },
+                      "array_task_string" : "2-4,7,10-14:2%2",
+                      "job_state" : ["PENDING"] } ]
+           self.reply(200, { "jobs" : jobs, "errors" : [] })
+        else:
+           self.reply(404, { "errors" : [ { "description" : "Unknown job" } ] })
+
+    def do_DELETE(self):
+        self.server.requests.append((self.command, self.path, self.headers))
+        self.reply(200, { "errors" : [] })
+
+
+
+class SlurmRESTTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeSlurmrestd)
+        self.server.requests = []
+        self.server.jobs = { }
+        self.server.next_id = 100
+        self.server.stall = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.scheduler = SlurmREST(url, "qcloud", "secret", "v0.0.39", 5)
+        self.jobdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.jobdir)
+
+    def test_submit(self):
+        with open(os.path.join(self.jobdir, "batch"), "w") as fh:
+           fh.write("#!/bin/bash\n#SBATCH --job-name=he.inp -n 2 --mem=4G\n")
+           fh.write("#SBATCH --time=1-02:00:00\nqchem input output\n")
+
+        slurmid = self.scheduler.submit(self.jobdir, "batch")
+        self.assertEqual(slurmid, "101")
+
+        (method, path, headers) = self.server.requests[0]
+        self.assertEqual(path, "/slurm/v0.0.39/job/submit")
+        self.assertEqual(headers["X-SLURM-USER-TOKEN"], "secret")
+
+        job = self.server.jobs[101]["job"]
+        self.assertEqual(job["name"], "he.inp")
+        self.assertEqual(job["tasks"], 2)
+        self.assertEqual(job["memory_per_node"], 4096)
+        self.assertEqual(job["time_limit"], 1560)
+        self.assertEqual(job["current_working_directory"], self.jobdir)
+
+    def test_states(self):
+        states = self.scheduler.states()
+        self.assertEqual(states, { "1" : "R", "2" : "PD", "8_1" : "CG",
+           "8_2" : "PD", "8_3" : "PD", "8_4" : "PD", "8_7" : "PD",
+           "8_10" : "PD", "8_12" : "PD", "8_14" : "PD" })
+
+    def test_errors(self):
+        self.assertRaises(SchedulerError, self.scheduler.info, 5)
+
+    def test_connection_reused(self):
+        self.scheduler.states()
+        self.scheduler.cancel(2)
+        self.scheduler.states()
+        conn = self.scheduler._SlurmREST__connection()
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertIsNotNone(conn.sock)
+
+    def test_timeout(self):
+        url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        scheduler = SlurmREST(url, "qcloud", "secret", "v0.0.39", 0.2)
+        self.server.stall = 1
+        self.assertIsNone(scheduler.states())
+        self.assertEqual(scheduler.states(), self.scheduler.states())
+        self.assertRaises(SchedulerError, scheduler.info, 5)
+
+    def test_conversions(self):
+        self.assertEqual(array_tasks("0-3%2"), [0, 1, 2, 3])
+        self.assertEqual(array_tasks("1,5-9:4"), [1, 5, 9])
+        self.assertEqual(time_limit("30"), 30)
+        self.assertEqual(time_limit("1:30:00"), 90)
+        self.assertEqual(time_limit("2-0"), 2880)
+        self.assertEqual(memory("512"), 512)
+        self.assertEqual(memory("2g"), 2048)
+
+
+if __name__ == '__main__':
+    unittest.main()
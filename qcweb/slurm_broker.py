@@ -0,0 +1,97 @@
+import json
+import socket
+import struct
+import itertools
+import threading
+
+
+header = struct.Struct("!I")
+
+
+
+class BrokerError(Exception):
+    pass
+
+
+
+class BrokerClient():
+    """Runs SLURM commands through the qcbroker daemon on the host.  Each
+    thread keeps its own connection to the broker, so commands issued from
+    different threads run concurrently."""
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+
+    def run(self, argv, timeout = None):
+        """Returns the exit status and output of the command"""
+        if (timeout is None):
+           timeout = self.timeout
+
+        request = { "id" : next(self.ids), "argv" : argv, "timeout" : timeout }
+        data = json.dumps(request).encode()
+        message = header.pack(len(data)) + data
+
+        try:
+            conn = self.__connection(timeout)
+            sent = conn.send(message)
+        except OSError:
+            # Nothing reached the broker, which may have been restarted
+            # since the connection was opened, so try once more on a new
+            # connection.  Once any of the request has gone out it is not
+            # sent again, as the command may already have been run.
+            self.__close()
+            try:
+                conn = self.__connection(timeout)
+                sent = conn.send(message)
+            except OSError as e:
+                self.__close()
+                raise BrokerError("Cannot reach broker for %s: %s" % (argv[0], str(e)))
+
+        try:
+            response = self.__response(conn, request, message[sent:])
+        except socket.timeout:
+            self.__close()
+            raise BrokerError("No response from broker for %s" % argv[0])
+        except (OSError, ValueError, BrokerError) as e:
+            self.__close()
+            raise BrokerError("Broker request for %s failed: %s" % (argv[0], str(e)))
+
+        return (response["status"], response["output"])
+
+    def __response(self, conn, request, rest):
+        conn.sendall(rest)
+
+        size = header.unpack(self.__recv(conn, header.size))[0]
+        response = json.loads(self.__recv(conn, size))
+        if (response.get("id") != request["id"]):
+           raise BrokerError("Mismatched broker response %s" % response.get("id"))
+        return response
+
+    def __recv(self, conn, size):
+        data = b''
+        while (len(data) < size):
+            chunk = conn.recv(size - len(data))
+            if (not chunk):
+               raise BrokerError("Broker closed the connection")
+            data += chunk
+        return data
+
+    def __connection(self, timeout):
+        conn = getattr(self.local, "conn", None)
+        if (conn is None):
+           conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+           conn.connect(self.path)
+           self.local.conn = conn
+        # Allow a little longer than the broker does so that its timeout
+        # message is seen rather than a socket error.
+        conn.settimeout(timeout + 5)
+        return conn
+
+    def __close(self):
+        conn = getattr(self.local, "conn", None)
+        if (conn is not None):
+           conn.close()
+           self.local.conn = None
@@ -0,0 +1,55 @@
+import time
+import hashlib
+import collections
+
+import qctoken
+
+
+def decode_token(token, keyring):
+    """Verifies the signature and expiry of a JWT issued by qcauth and
+    returns its claims.  Failures are reported with the same messages as
+    the authentication server so clients can recognise them."""
+    try:
+        return qctoken.decode(token, keyring)
+    except qctoken.TokenError as e:
+        raise Exception(str(e))
+
+
+
+def token_claims(token):
+    """Returns the claims of a token that has already been validated"""
+    return qctoken.claims(token)
+
+
+
+class TokenCache():
+    """Bounded LRU of validated tokens, keyed by the hash of the token,
+    holding the userid and jti of each.  Entries are dropped once the token
+    expires."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, token):
+        key = hashlib.sha256(token.encode()).digest()
+        entry = self.entries.get(key)
+        if (entry is None):
+           return None
+
+        (userid, exp, jti) = entry
+        if (exp is not None and exp <= time.time()):
+           del self.entries[key]
+           return None
+
+        self.entries.move_to_end(key)
+        return (userid, jti)
+
+    def put(self, token, userid, exp, jti = None):
+        if (self.size <= 0):
+           return
+        key = hashlib.sha256(token.encode()).digest()
+        self.entries[key] = (userid, exp, jti)
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.size):
+           self.entries.popitem(last=False)
@@ -0,0 +1,84 @@
+#
+#  Revocation of access tokens by their jti claim.  The same file is used by
+#  qcauth, which revokes tokens, and qcweb, which checks them in-process;
+#  keep the two copies identical.
+#
+#  A revoked token has a revoked:<jti> key holding its exp, which expires
+#  with the token, and its jti is published on the revocations channel.
+#  Validators keep the revoked jtis in memory, loaded from the keys and
+#  kept up to date from the channel, so checking a token costs a set
+#  lookup rather than a round trip to redis.
+#
+
+import time
+import logging
+import tornado.gen
+import redis.asyncio
+
+
+channel = "revocations"
+
+
+
+def revoke(pipe, jti, exp):
+    """Adds the revocation of a token to a pipeline of the synchronous
+    client.  Tokens without an expiry stay revoked."""
+    pipe.set("revoked:%s" % jti, exp or "")
+    if (exp):
+       pipe.expireat("revoked:%s" % jti, int(exp))
+    pipe.publish(channel, "%s %s" % (jti, exp or ""))
+
+
+
+class RevocationList():
+    def __init__(self, config):
+        redis_host = config.get("redis", "host")
+        redis_port = config.get("redis", "port")
+        self.db = redis.asyncio.StrictRedis(host=redis_host, port=redis_port,
+           db=0, decode_responses=True)
+        # jti -> exp, or None for tokens that do not expire
+        self.revoked = { }
+        self.purged = time.time()
+
+
+    def is_revoked(self, jti):
+        return jti is not None and jti in self.revoked
+
+
+    def add(self, jti, exp):
+        self.revoked[jti] = float(exp) if exp else None
+
+        # Revoked tokens that have expired fail validation anyway
+        now = time.time()
+        if (now - self.purged > 60):
+           self.revoked = { jti : exp for (jti, exp) in self.revoked.items()
+                               if exp is None or exp > now }
+           self.purged = now
+
+
+    async def load(self):
+        async for key in self.db.scan_iter(match="revoked:*", count=1000):
+            exp = await self.db.get(key)
+            if (exp is not None):
+               self.add(key.split(":", 1)[1], exp)
+
+
+    async def run(self):
+        while True:
+            try:
+                pubsub = self.db.pubsub()
+                await pubsub.subscribe(channel)
+                # Loaded after subscribing so that nothing revoked while
+                # we were disconnected is missed
+                await self.load()
+                logging.info("Subscribed to token revocations, %d revoked" % len(self.revoked))
+
+                async for message in pubsub.listen():
+                    if (message["type"] != "message"):
+                       continue
+                    (jti, _, exp) = message["data"].partition(" ")
+                    self.add(jti, exp)
+
+            except Exception as e:
+                logging.error("Token revocation connection lost: %s" % str(e))
+                await tornado.gen.sleep(1)
@@ -0,0 +1,50 @@
+import re
+import time
+import collections
+
+
+class UserActivity():
+    """Keeps the records of active anonymous users from expiring.  qcauth
+    removes an anonymous user, and the list of their tokens, after
+    anon_user_ttl seconds without a request to it, but clients only go to
+    qcauth to register.  Tokens verified here extend both records, at most
+    once every touch_period seconds for each user in each process."""
+
+    # Users touched recently, remembered by each process
+    local_size = 100000
+
+    def __init__(self, db, config):
+        self.db = db
+        self.anon = config.getboolean("authentication", "anon", fallback=False)
+        self.ttl = config.getint("retention", "anon_user_ttl", fallback=0)
+        self.period = min(config.getint("retention", "anon_touch_period", fallback=86400),
+           self.ttl // 2)
+        self.touched = collections.OrderedDict()
+        # Anonymous users are known by their userid, unlike the admin
+        self.userid_re = re.compile("^[a-z0-9]{32}$")
+
+
+    def touch(self, userid):
+        """Extends the records of an anonymous user.  Raises an exception if
+        the user no longer exists, as their tokens can no longer be
+        revoked."""
+        if (not self.anon or self.ttl <= 0 or not self.userid_re.match(userid)):
+           return
+
+        now = time.time()
+        last = self.touched.get(userid)
+        if (last is not None and now - last < self.period):
+           return
+
+        with self.db.pipeline(transaction=False) as p:
+            p.expire("user:%s" % userid, self.ttl)
+            p.expire("tokens:%s" % userid, self.ttl)
+            (exists, _) = p.execute()
+        if (not exists):
+           self.touched.pop(userid, None)
+           raise Exception("JWT invalid token")
+
+        self.touched[userid] = now
+        self.touched.move_to_end(userid)
+        while (len(self.touched) > self.local_size):
+           self.touched.popitem(last=False)
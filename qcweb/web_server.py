@@ -1,28 +1,118 @@
 import os
+import re
 import sys
 import ssl
+import math
+import time
+import types
+import json
 import logging
+import zipfile
+import importlib.util
+import datetime
 import configparser
-import urllib.request
+import concurrent.futures
 
+import tornado.gen
+import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.queues
+import tornado.util
 import tornado.web
 
 from job_manager import JobManager
+from archive_stream import ArchiveBuffer, select_files, tar_header, tar_padding, TAR_END
+from compression import negotiate, read_chunks, compress_chunks, Compressor
+from job_watcher import JobWatcher
+from workdir_gc import WorkdirGC
+from token_cache import TokenCache, decode_token, token_claims
+from token_revocations import RevocationList
+from rate_limit import RateLimiter
+from user_activity import UserActivity
+from qctoken import keyring_from_config
+
+
+def configure_http_client(max_clients):
+    """Selects the client used to talk to the authentication server.  The
+    curl client keeps connections alive between requests; the simple client
+    is used if pycurl is not installed."""
+    if (importlib.util.find_spec("pycurl") is not None):
+       tornado.httpclient.AsyncHTTPClient.configure(
+          "tornado.curl_httpclient.CurlAsyncHTTPClient", max_clients=max_clients)
+    else:
+       logging.warning("pycurl not found, authentication requests will not use keep-alive")
+       tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=max_clients)
+
 
 
 class BaseHandler(tornado.web.RequestHandler):
-    def initialize(self, authentication_url, job_manager):
+    def initialize(self, authentication_url, authentication_timeout,
+                   token_validation, token_cache, jwt_keyring, revocations, rate_limiter,
+                   user_activity, job_manager):
         self.authentication_url = authentication_url
+        self.authentication_timeout = authentication_timeout
+        self.token_validation = token_validation
+        self.token_cache = token_cache
+        self.jwt_keyring = jwt_keyring
+        self.revocations = revocations
+        self.rate_limiter = rate_limiter
+        self.user_activity = user_activity
         self.job_manager = job_manager
-
-
-    def validate_token(self, token):
-        url = self.authentication_url + "/validate"
-        req = urllib.request.Request(url)
-        req.add_header("Qcloud-Token", token)
-        res = urllib.request.urlopen(req)
+        self.http_client = tornado.httpclient.AsyncHTTPClient()
+
+
+    def check_rate(self, name, ident, cost = 1):
+        """Refuses the request with a 429 if ident is over the named limit"""
+        wait = self.rate_limiter.check(name, ident, cost)
+        if (wait > 0):
+           self.set_status(429)
+           self.set_header("Retry-After", int(math.ceil(wait)))
+           raise Exception("Too many requests, retry after %d seconds" % math.ceil(wait))
+
+
+    async def auth_request(self, path, headers = { }):
+        # qcauth limits requests by the address of our client, and its
+        # refusals are passed on with the time to wait
+        headers = dict(headers, **{ "X-Forwarded-For" :
+           self.rate_limiter.client_address(self.request) })
+        req = tornado.httpclient.HTTPRequest(self.authentication_url + path,
+                 headers = headers, request_timeout = self.authentication_timeout)
+        res = await self.http_client.fetch(req, raise_error=False)
+        if (res.code == 429):
+           self.set_status(429)
+           if ("Retry-After" in res.headers):
+              self.set_header("Retry-After", res.headers["Retry-After"])
+           raise Exception(res.headers.get("Qcloud-Server-Message", "Too many requests"))
+        res.rethrow()
+        return res
+
+
+    async def validate_token(self, token):
+        self.check_rate("request_ip", self.rate_limiter.client_address(self.request))
+        entry = self.token_cache.get(token)
+        if (entry is None):
+           if (self.token_validation == "local"):
+              claims = decode_token(token, self.jwt_keyring)
+              userid = str(claims["userid"])
+           else:
+              userid = await self.validate_token_remote(token)
+              claims = token_claims(token)
+           entry = (userid, claims.get("jti"))
+           self.token_cache.put(token, userid, claims.get("exp"), claims.get("jti"))
+
+        # Revocations are checked on every request, cached or not
+        (userid, jti) = entry
+        if (self.revocations.is_revoked(jti)):
+           raise Exception("JWT revoked token")
+        self.user_activity.touch(userid)
+        self.check_rate("request_user", userid)
+        return userid
+
+
+    async def validate_token_remote(self, token):
+        res = await self.auth_request("/validate", { "Qcloud-Token" : token })
 
         if (not res.headers.get("Qcloud-Server-Status") == "OK"):
            msg = res.headers.get("Qcloud-Server-Message")
@@ -31,27 +121,28 @@ class BaseHandler(tornado.web.RequestHandler):
         return res.headers.get("Qcloud-Server-Userid")
 
 
-    def get_job(self):
+    async def get_job(self):
         token  = self.get_argument("cookie")
         jobid  = self.get_argument("jobid")
-        userid = self.validate_token(token)
-        job    = self.job_manager.get_job(jobid)
+        userid = await self.validate_token(token)
+        job    = self.job_manager.get_job(jobid, userid)
 
-        # need to match job with user?
+        # Jobs submitted by other users are not found, so as not to reveal
+        # that they exist
         if (not job.is_valid()):
-           job.status = "INVALID"
-           #raise Exception("Invalid jobid")
+           self.set_status(404)
+           raise Exception("Invalid jobid " + jobid)
 
+        self.userid = userid
         return job
 
        
 
 class Register(BaseHandler):
-    def get(self):
+    async def get(self):
         try:
-            url = self.authentication_url + "/register"
-            req = urllib.request.Request(url)
-            res = urllib.request.urlopen(req)
+            self.check_rate("request_ip", self.rate_limiter.client_address(self.request))
+            res = await self.auth_request("/register")
 
             userid = res.headers["Qcloud-Server-Userid"]
             token  = res.headers["Qcloud-Token"]
@@ -70,25 +161,76 @@ class Register(BaseHandler):
 
 
 class SubmitJob(BaseHandler):
-    def post(self):
+    async def post(self):
         try:
             token  = self.get_argument("cookie")
-            userid = self.validate_token(token)
+            userid = await self.validate_token(token)
             if (userid is None):
                raise tornado.web.HTTPError(401, log_message="Invalid token passed to submit")
 
+            # Identical inputs reuse an earlier result unless cache=no
+            self.check_rate("submit_user", userid)
             input = self.request.body.decode()
-            job   = self.job_manager.submit_job(input)
+            cache = self.get_argument("cache", "yes") != "no"
+            job   = self.job_manager.submit_job(input, userid, cache)
+            if (job.status == "PENDING"):
+               self.application.queue_submission(job.jobid)
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Jobid", job.jobid)
-            self.set_header("Qcloud-Server-Slurmid", job.slurmid)
+            self.set_header("Qcloud-Server-Jobstatus", job.status)
 
             self.set_header("Qchemserv-Status", "OK")
             self.set_header("Qchemserv-Request", "submit")
             self.set_header("Qchemserv-Jobid", job.jobid)
 
-            logging.info("Job %s submitted; UID=%s, JID=%s" % (job.slurmid, userid, job.jobid))
+            logging.info("Job submitted; UID=%s, JID=%s" % (userid, job.jobid))
+
+        except tornado.web.MissingArgumentError as e:
+            msg = "Missing argument: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+
+
+
+
+class SubmitBatch(BaseHandler):
+    async def post(self):
+        try:
+            token  = self.get_argument("cookie")
+            userid = await self.validate_token(token)
+
+            slurm  = self.get_argument("slurm", "")
+            inputs = self.request.files.get("input", [])
+            if (not inputs):
+               raise Exception("No input files passed to batch submit")
+
+            # Each input of a batch counts as a submission
+            self.check_rate("submit_user", userid, len(inputs))
+            inputs = [(f.filename, f.body.decode()) for f in inputs]
+            cache  = self.get_argument("cache", "yes") != "no"
+            # Writing thousands of job directories takes too long to do on
+            # the IOLoop
+            loop = tornado.ioloop.IOLoop.current()
+            (jobs, arrays) = await loop.run_in_executor(None,
+               self.job_manager.submit_batch, slurm, inputs, userid, cache)
+            for arrayid in arrays:
+                self.application.queue_array_submission(arrayid)
+
+            jobids = [{ "input" : name, "jobid" : job.jobid, "status" : job.status }
+                         for ((name, input), job) in zip(inputs, jobs)]
+            self.write({ "jobs" : jobids })
+
+            self.set_header("Qcloud-Server-Status", "OK")
+
+            self.set_header("Qchemserv-Status", "OK")
+            self.set_header("Qchemserv-Request", "submit")
+
+            logging.info("Batch submitted; UID=%s, jobs=%d, arrays=%d" % (userid, len(jobs), len(arrays)))
 
         except tornado.web.MissingArgumentError as e:
             msg = "Missing argument: " + str(e)
@@ -103,17 +245,26 @@ class SubmitJob(BaseHandler):
 
 
 class ListFiles(BaseHandler):
-    def prepare(self):
+    async def prepare(self):
         try:
-            job = self.get_job()
+            job = await self.get_job()
             #if (job.status != "DONE"):
             #   raise Exception("Job not completed")
 
-            filelist = job.files
-            body = ''
-            for f in filelist:
-                body += ("%s\n" % f)
-            self.write(body)
+            if (self.get_argument("format", "text") == "json"):
+               # The manifest gives the size, mtime and, if requested, the
+               # sha256 of each file
+               checksums = self.get_argument("checksum", "no") == "yes"
+               loop = tornado.ioloop.IOLoop.current()
+               manifest = await loop.run_in_executor(None,
+                  self.job_manager.get_manifest, job, checksums)
+               self.write({ "jobid" : job.jobid, "status" : job.status, "files" : manifest })
+            else:
+               filelist = job.files
+               body = ''
+               for f in filelist:
+                   body += ("%s\n" % f)
+               self.write(body)
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Jobid", job.jobid)
@@ -141,18 +292,67 @@ class ListFiles(BaseHandler):
  
 
 
+def parse_range(header, size):
+    """Returns the (start, end) offsets of a single byte range request, with
+    end exclusive, or None if the header cannot be parsed"""
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if (not match or match.group(1) == match.group(2) == ''):
+       return None
+
+    (start, end) = match.groups()
+    if (start == ''):
+       return (max(size - int(end), 0), size)
+
+    start = int(start)
+    end = size if end == '' else min(int(end) + 1, size)
+    return (start, end)
+
+
+
 class Download(BaseHandler):
-    def prepare(self):
+    # Files are streamed in blocks of this size so that memory use does not
+    # depend on the size of the file.
+    chunk_size = 64 * 1024
+
+    def initialize(self, accel_redirect, **kwargs):
+        BaseHandler.initialize(self, **kwargs)
+        self.accel_redirect = accel_redirect
+
+
+    async def prepare(self):
         try:
-            job   = self.get_job()
+            job   = await self.get_job()
             fname = self.get_argument("file")
-            fpath = self.job_manager.get_job_filepath(job.jobid, fname)
+            if (os.path.basename(fname) != fname):
+               raise Exception("File not found " + fname)
+            # The manifest of a finished job saves checking the file exists
+            manifest = job.manifest if job.status == "DONE" else None
+            fpath = self.job_manager.get_job_filepath(job.jobid, fname, manifest)
             if (fpath is None):
                raise Exception("File not found " + fname)
 
-            with open(fpath, 'r') as file:
-               data = file.read()
-            self.write(data)
+            # Files stored compressed keep their uncompressed size in the
+            # manifest, ranges are offsets into the uncompressed file
+            stored = manifest[fname].get("encoding") if manifest else None
+            stat = os.stat(fpath)
+            size = manifest[fname]["size"] if stored else stat.st_size
+            (start, end) = (0, size)
+
+            range_header = self.request.headers.get("Range")
+            encoding = None
+            if (range_header):
+               byte_range = parse_range(range_header, size)
+               if (byte_range is None or byte_range[0] >= byte_range[1]):
+                  self.set_status(416)
+                  self.set_header("Content-Range", "bytes */%d" % size)
+                  raise Exception("Invalid range %s for file %s" % (range_header, fname))
+               (start, end) = byte_range
+               self.set_status(206)
+               self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end-1, size))
+            elif (stored or not self.accel_redirect):
+               # Files that are not stored compressed are left to the proxy
+               # to compress, if there is one
+               encoding = negotiate(self.request.headers.get("Accept-Encoding"), stored)
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Jobid", job.jobid)
@@ -161,8 +361,110 @@ class Download(BaseHandler):
             self.set_header("Qchemserv-Request", "download")
             self.set_header("Qchemserv-Jobid", job.jobid)
 
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Accept-Ranges", "bytes")
+            self.set_header("Vary", "Accept-Encoding")
+            if (encoding is not None):
+               self.set_header("Content-Encoding", encoding)
+            self.set_header("Etag", '"%x-%x%s"' % (stat.st_mtime_ns, size,
+               "-" + encoding if encoding else ""))
+            if (self.check_etag_header()):
+               self.set_status(304)
+               return
+
             logging.info("File download; JID=%s  file=%s " % (job.jobid, fname))
 
+            if (self.accel_redirect and stored is None):
+               # Hand the transfer to the front end proxy which can use
+               # sendfile and deal with ranges itself.
+               self.clear_header("Content-Range")
+               self.set_status(200)
+               relpath = os.path.relpath(fpath, self.job_manager.workdir)
+               self.set_header("X-Accel-Redirect", self.accel_redirect + "/" + relpath)
+               return
+
+            if (encoding is not None and encoding == stored):
+               # Sent as stored
+               self.set_header("Content-Length", stat.st_size)
+               chunks = read_chunks(fpath, None, 0, None, self.chunk_size)
+            elif (encoding is not None):
+               chunks = compress_chunks(
+                  read_chunks(fpath, stored, 0, None, self.chunk_size), encoding)
+            else:
+               self.set_header("Content-Length", end - start)
+               chunks = read_chunks(fpath, stored, start, end, self.chunk_size)
+
+            for chunk in chunks:
+                self.write(chunk)
+                await self.flush()
+
+        except tornado.iostream.StreamClosedError:
+            logging.info("Download interrupted; JID=%s  file=%s " % (job.jobid, fname))
+
+        except tornado.web.MissingArgumentError as e:
+            msg = "Missing argument: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+
+    def get(self):
+        pass
+
+    def post(self):
+        pass
+
+
+
+class Archive(BaseHandler):
+    # Files are added to the archive in blocks of this size and each block
+    # is flushed to the client before the next is read.
+    chunk_size = 64 * 1024
+
+    async def prepare(self):
+        try:
+            job     = await self.get_job()
+            format  = self.get_argument("format", "tar")
+            include = self.get_arguments("include")
+            exclude = self.get_arguments("exclude")
+
+            if (format != "tar" and format != "zip"):
+               raise Exception("Unknown archive format " + format)
+
+            workdir = self.job_manager.get_job_workdir(job.jobid)
+            names = job.manifest if job.status == "DONE" else None
+            files = select_files(workdir, include, exclude, names)
+
+            self.set_header("Qcloud-Server-Status", "OK")
+            self.set_header("Qcloud-Server-Jobid", job.jobid)
+
+            self.set_header("Qchemserv-Status", "OK")
+            self.set_header("Qchemserv-Request", "archive")
+            self.set_header("Qchemserv-Jobid", job.jobid)
+
+            self.set_header("Content-Disposition",
+               "attachment; filename=%s.%s" % (job.jobid, format))
+
+            logging.info("Job archive;   JID=%s  files=%d" % (job.jobid, len(files)))
+
+            if (format == "tar"):
+               # Zip entries are compressed already, tar streams are
+               # compressed as a whole if the client accepts it
+               encoding = negotiate(self.request.headers.get("Accept-Encoding"))
+               self.set_header("Content-Type", "application/x-tar")
+               self.set_header("Vary", "Accept-Encoding")
+               if (encoding is not None):
+                  self.set_header("Content-Encoding", encoding)
+               await self.stream_tar(workdir, files, names, encoding)
+            else:
+               self.set_header("Content-Type", "application/zip")
+               await self.stream_zip(workdir, files, names)
+
+        except tornado.iostream.StreamClosedError:
+            logging.info("Archive interrupted; JID=%s" % (job.jobid))
+
         except tornado.web.MissingArgumentError as e:
             msg = "Missing argument: " + str(e)
             self.set_header("Qcloud-Server-Message", msg)
@@ -172,6 +474,63 @@ class Download(BaseHandler):
             logging.error(msg)
             self.set_header("Qcloud-Server-Message", msg)
 
+
+    async def stream_tar(self, workdir, files, manifest, encoding):
+        compressor = Compressor(encoding) if encoding else None
+        def send(data):
+            self.write(compressor.compress(data) if compressor else data)
+
+        for fname in files:
+            entry = manifest.get(fname, { }) if manifest else { }
+            fpath = os.path.join(workdir, entry.get("stored", fname))
+            if ("encoding" in entry):
+               # Files stored compressed are added uncompressed
+               stat = types.SimpleNamespace(st_size=entry["size"], st_mtime=entry["mtime"])
+            else:
+               stat = os.stat(fpath)
+            send(tar_header(fname, stat))
+
+            # The header fixes the size of the entry, so a file that is
+            # still being written is truncated or padded to match.
+            remaining = stat.st_size
+            for chunk in read_chunks(fpath, entry.get("encoding"), 0, stat.st_size, self.chunk_size):
+                remaining -= len(chunk)
+                send(chunk)
+                await self.flush()
+            while (remaining > 0):
+                chunk = b'\0' * min(self.chunk_size, remaining)
+                remaining -= len(chunk)
+                send(chunk)
+
+            send(tar_padding(stat.st_size))
+
+        send(TAR_END)
+        if (compressor is not None):
+           self.write(compressor.finish())
+        await self.flush()
+
+
+    async def stream_zip(self, workdir, files, manifest):
+        buffer = ArchiveBuffer()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for fname in files:
+                entry = manifest.get(fname, { }) if manifest else { }
+                fpath = os.path.join(workdir, entry.get("stored", fname))
+                info = zipfile.ZipInfo.from_file(fpath, fname)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                if ("encoding" in entry):
+                   info.file_size = entry["size"]
+                   info.date_time = time.localtime(entry["mtime"])[0:6]
+
+                with archive.open(info, 'w') as dst:
+                    for chunk in read_chunks(fpath, entry.get("encoding"), 0, None, self.chunk_size):
+                        dst.write(chunk)
+                        self.write(buffer.drain())
+                        await self.flush()
+
+        self.write(buffer.drain())
+        await self.flush()
+
     def get(self):
         pass
 
@@ -181,9 +540,9 @@ class Download(BaseHandler):
 
 
 class JobStatus(BaseHandler):
-    def prepare(self):
+    async def prepare(self):
         try:
-            job = self.get_job()
+            job = await self.get_job()
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Jobid", job.jobid)
@@ -213,10 +572,257 @@ class JobStatus(BaseHandler):
 
 
 
+class BatchStatus(BaseHandler):
+    async def prepare(self):
+        try:
+            token  = self.get_argument("cookie")
+            jobids = self.get_arguments("jobid")
+            userid = await self.validate_token(token)
+
+            statuses = { }
+            for job in self.job_manager.get_jobs(jobids, userid):
+                statuses[job.jobid] = job.status if job.is_valid() else "INVALID"
+            self.write(statuses)
+
+            self.set_header("Qcloud-Server-Status", "OK")
+
+            self.set_header("Qchemserv-Status", "OK")
+            self.set_header("Qchemserv-Request", "status")
+
+            logging.info("Batch status;  UID=%s  jobs=%d" % (userid, len(jobids)))
+
+        except tornado.web.MissingArgumentError as e:
+            msg = "Missing argument: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+
+    def get(self):
+        pass
+
+    def post(self):
+        pass
+
+
+
+class ListJobs(BaseHandler):
+    async def prepare(self):
+        try:
+            token    = self.get_argument("cookie")
+            statuses = self.get_arguments("status")
+            cursor   = self.get_argument("cursor", None)
+            count    = min(int(self.get_argument("count", 50)), 500)
+            userid   = await self.validate_token(token)
+
+            (jobs, cursor) = self.job_manager.list_jobs(userid, statuses, cursor, count)
+            jobs = [{ "jobid" : job.jobid, "status" : job.status, "submitted" : submitted }
+                       for (job, submitted) in jobs]
+            self.write({ "jobs" : jobs, "cursor" : cursor })
+
+            self.set_header("Qcloud-Server-Status", "OK")
+
+            self.set_header("Qchemserv-Status", "OK")
+            self.set_header("Qchemserv-Request", "jobs")
+
+            logging.info("Job listing;   UID=%s  jobs=%d" % (userid, len(jobs)))
+
+        except tornado.web.MissingArgumentError as e:
+            msg = "Missing argument: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+
+    def get(self):
+        pass
+
+    def post(self):
+        pass
+
+
+
+class WatchJobs(BaseHandler):
+    # A job is no longer watched once it reaches one of these states
+    final_states = ("DONE", "ERROR", "DELETED", "INVALID")
+
+    def initialize(self, job_watcher, heartbeat, **kwargs):
+        BaseHandler.initialize(self, **kwargs)
+        self.job_watcher = job_watcher
+        self.heartbeat = heartbeat
+
+
+    async def get(self):
+        try:
+            token  = self.get_argument("cookie")
+            jobids = self.get_arguments("jobid")
+            if (not jobids):
+               raise tornado.web.MissingArgumentError("jobid")
+            self.userid = await self.validate_token(token)
+
+        except tornado.web.MissingArgumentError as e:
+            msg = "Missing argument: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+            return
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+            return
+
+        self.set_header("Qcloud-Server-Status", "OK")
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        logging.info("Job watch;     UID=%s  jobs=%d" % (self.userid, len(jobids)))
+
+        # Jobs that do not exist or belong to someone else are reported
+        # as INVALID once and not watched, so none of their changes are sent
+        self.last_status = { }
+        jobs = self.job_manager.get_jobs(jobids, self.userid)
+        for job in jobs:
+            self.send_status(job.jobid, job.status if job.is_valid() else "INVALID")
+        jobids = [job.jobid for job in jobs if job.is_valid()]
+
+        queue = tornado.queues.Queue()
+        for jobid in jobids:
+            self.job_watcher.watch(jobid, queue)
+
+        try:
+            await self.flush()
+
+            while (self.pending()):
+                try:
+                    (jobid, status) = await queue.get(
+                       timeout=datetime.timedelta(seconds=self.heartbeat))
+                    self.send_status(jobid, status)
+                except tornado.util.TimeoutError:
+                    # Catch any changes published while the watcher was
+                    # disconnected and keep the connection alive.
+                    self.refresh(self.pending())
+                    self.write(": keepalive\n\n")
+                await self.flush()
+
+        except tornado.iostream.StreamClosedError:
+            pass
+
+        finally:
+            for jobid in jobids:
+                self.job_watcher.unwatch(jobid, queue)
+
+
+    def pending(self):
+        return [jobid for (jobid, status) in self.last_status.items()
+                   if status not in self.final_states]
+
+
+    def refresh(self, jobids):
+        for job in self.job_manager.get_jobs(jobids, self.userid):
+            self.send_status(job.jobid, job.status if job.is_valid() else "INVALID")
+
+
+    def send_status(self, jobid, status):
+        if (self.last_status.get(jobid) == status):
+           return
+        self.last_status[jobid] = status
+        event = json.dumps({ "jobid" : jobid, "status" : status })
+        self.write("event: status\ndata: %s\n\n" % event)
+
+
+
+class TailFile(BaseHandler):
+    """Streams a file in the job workdir from the given offset and keeps
+    sending what is appended to it until the job finishes.  The file
+    defaults to the Q-Chem output."""
+
+    chunk_size = 64 * 1024
+
+    def initialize(self, poll_interval, **kwargs):
+        BaseHandler.initialize(self, **kwargs)
+        self.poll_interval = poll_interval
+
+
+    async def get(self):
+        try:
+            job    = await self.get_job()
+            fname  = self.get_argument("file", job.output)
+            offset = int(self.get_argument("offset", 0))
+            if (os.path.basename(fname) != fname):
+               raise Exception("File not found " + fname)
+            # The output of a finished job may be stored compressed
+            entry = job.manifest.get(fname, { }) if job.status == "DONE" and job.manifest else { }
+            fpath = os.path.join(self.job_manager.get_job_workdir(job.jobid),
+               entry.get("stored", fname))
+
+        except tornado.web.MissingArgumentError as e:
+            msg = "Missing argument: " + str(e)
+            self.set_header("Qcloud-Server-Message", msg)
+            return
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+            return
+
+        self.set_header("Qcloud-Server-Status", "OK")
+        self.set_header("Qcloud-Server-Jobid", job.jobid)
+        self.set_header("Qcloud-Server-File", fname)
+        self.set_header("Content-Type", "application/octet-stream")
+        self.set_header("Cache-Control", "no-cache")
+        logging.info("File tail;     JID=%s  file=%s  offset=%d" % (job.jobid, fname, offset))
+
+        file = None
+        try:
+            await self.flush()
+            if ("encoding" in entry):
+               for chunk in read_chunks(fpath, entry["encoding"], offset, None, self.chunk_size):
+                   self.write(chunk)
+                   await self.flush()
+               return
+
+            status = job.status
+            while True:
+                if (file is None and os.path.isfile(fpath)):
+                   file = open(fpath, 'rb')
+                   file.seek(offset)
+
+                sent = 0
+                if (file is not None):
+                   # Only read when the file has grown
+                   while (os.fstat(file.fileno()).st_size > file.tell()):
+                       chunk = file.read(self.chunk_size)
+                       if (not chunk):
+                          break
+                       sent += len(chunk)
+                       self.write(chunk)
+                       await self.flush()
+
+                # The file is complete once the job has finished and
+                # everything written before that has been sent
+                if (status in WatchJobs.final_states and sent == 0):
+                   break
+
+                await tornado.gen.sleep(self.poll_interval)
+                status = self.job_manager.get_job(job.jobid).status
+
+        except tornado.iostream.StreamClosedError:
+            logging.info("Tail closed;   JID=%s  file=%s" % (job.jobid, fname))
+
+        finally:
+            if (file is not None):
+               file.close()
+
+
+
 class JobInfo(BaseHandler):
-    def prepare(self):
+    async def prepare(self):
         try:
-            job  = self.get_job()
+            job  = await self.get_job()
             info = self.job_manager.get_job_info(job)
 
             self.write(info)
@@ -249,11 +855,11 @@ class JobInfo(BaseHandler):
 
 
 class DeleteJob(BaseHandler):
-    def prepare(self):
+    async def prepare(self):
         try:
-            job = self.get_job()
+            job = await self.get_job()
            
-            self.job_manager.delete_job(job.jobid)
+            self.job_manager.delete_job(job.jobid, self.userid)
 
             self.set_header("Qcloud-Server-Status", "OK")
             self.set_header("Qcloud-Server-Jobid", job.jobid)
@@ -282,26 +888,96 @@ class DeleteJob(BaseHandler):
 
 
 
+class Metrics(tornado.web.RequestHandler):
+    """Reports the workdir GC totals in the Prometheus text format"""
+
+    def initialize(self, job_manager):
+        self.job_manager = job_manager
+
+    def get(self):
+        try:
+            stats = self.job_manager.db.hgetall("gc:stats")
+            body = ''
+            for name in sorted(stats):
+                metric = "qcloud_gc_%s" % name
+                if (name.startswith("reclaimed_") or name.startswith("workdirs_")):
+                   body += "# TYPE %s counter\n" % metric
+                else:
+                   body += "# TYPE %s gauge\n" % metric
+                body += "%s %s\n" % (metric, stats[name])
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(body)
+
+        except Exception as e:
+            msg = str(e);
+            logging.error(msg)
+            self.set_header("Qcloud-Server-Message", msg)
+            self.set_status(500)
+
+
+
 class ComputeServer(tornado.web.Application):
     def __init__(self, config):
         job_manager = JobManager(config)
+        self.job_manager = job_manager
 
         # Authentication server details
         host = config.get("authentication", "host")
         port = config.get("authentication", "port")
         auth_url = "http://" + host + ":" + port
+        auth_timeout = config.getfloat("authentication", "timeout", fallback=10)
+
+        configure_http_client(config.getint("authentication", "max_clients", fallback=100))
+
+        # Tokens are verified in-process with the shared JWT key unless
+        # validation is set to "remote", in which case every token not
+        # already in the cache is checked by the authentication server.
+        validation = config.get("authentication", "validation", fallback="local")
+        cache_size = config.getint("authentication", "token_cache_size", fallback=10000)
+
+        # Tokens revoked by qcauth, kept up to date by the run coroutine
+        self.revocations = RevocationList(config)
+        logging.info("Token validation: %s, cache size %d" % (validation, cache_size))
 
         args = dict( authentication_url = auth_url,
+                     authentication_timeout = auth_timeout,
+                     token_validation = validation,
+                     token_cache = TokenCache(cache_size),
+                     jwt_keyring = keyring_from_config(config),
+                     revocations = self.revocations,
+                     rate_limiter = RateLimiter(job_manager.db, config),
+                     user_activity = UserActivity(job_manager.db, config),
                      job_manager = job_manager )
 
+        # If qcweb sits behind a proxy that supports X-Accel-Redirect, file
+        # transfers are passed to the proxy under this location.
+        download_args = dict(args,
+           accel_redirect = config.get("server", "accel_redirect", fallback=None))
+
+        # Status changes are pushed to /watch requests as server-sent events
+        self.job_watcher = JobWatcher(config)
+        watch_args = dict(args,
+           job_watcher = self.job_watcher,
+           heartbeat = config.getfloat("server", "watch_heartbeat", fallback=15))
+
+        tail_args = dict(args,
+           poll_interval = config.getfloat("server", "tail_poll", fallback=2))
+
         handlers = [ 
             (r"/register", Register,  args),
             (r"/submit",   SubmitJob, args),
+            (r"/submit/batch", SubmitBatch, args),
             (r"/delete",   DeleteJob, args),  
             (r"/status",   JobStatus, args),
+            (r"/status/batch", BatchStatus, args),
+            (r"/jobs",     ListJobs,  args),
             (r"/list",     ListFiles, args),
             (r"/info",     JobInfo,   args),
-            (r"/download", Download,  args),
+            (r"/download", Download,  download_args),
+            (r"/archive",  Archive,   args),
+            (r"/watch",    WatchJobs, watch_args),
+            (r"/tail",     TailFile,  tail_args),
+            (r"/metrics",  Metrics,   dict(job_manager = job_manager)),
         ]   
 
         settings = { 
@@ -310,6 +986,105 @@ class ComputeServer(tornado.web.Application):
 
         tornado.web.Application.__init__(self, handlers, **settings)
 
+        # Job states are refreshed from SLURM in the background so that
+        # status requests only read from redis.
+        period = config.getfloat("queue", "reconcile_period", fallback=5)
+        self.reconciler = tornado.ioloop.PeriodicCallback(self.reconcile, period*1000)
+
+        # Records of finished jobs are moved out of redis once their
+        # retention period has passed
+        period = config.getfloat("retention", "period", fallback=300)
+        self.retirer = tornado.ioloop.PeriodicCallback(self.retire, period*1000)
+
+        # Outputs of finished jobs are compressed in the background
+        self.compressor = None
+        if (job_manager.compress_outputs != "none"):
+           period = config.getfloat("server", "compress_period", fallback=60)
+           self.compressor = tornado.ioloop.PeriodicCallback(self.compress_outputs, period*1000)
+
+        # Workdirs of finished jobs are deleted or moved to tier_dir once
+        # they reach the configured age.  A period of 0 leaves this to
+        # workdir_gc.py run from cron.
+        self.workdir_gc = WorkdirGC(job_manager, config)
+        period = config.getfloat("gc", "period", fallback=0)
+        self.collector = None
+        if (period > 0):
+           self.collector = tornado.ioloop.PeriodicCallback(self.collect_workdirs, period*1000)
+
+        # Jobs are acknowledged as soon as their files are written and are
+        # passed to SLURM by this pool
+        workers = config.getint("queue", "submit_workers", fallback=4)
+        self.submitter = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+    def start(self):
+        self.job_manager.migrate()
+        self.reconciler.start()
+        self.retirer.start()
+        if (self.collector is not None):
+           self.collector.start()
+        if (self.compressor is not None):
+           self.compressor.start()
+        tornado.ioloop.IOLoop.current().spawn_callback(self.job_watcher.run)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.revocations.run)
+
+        # Resubmit anything accepted before the last shutdown
+        for jobid in self.job_manager.pending_jobs():
+            self.queue_submission(jobid)
+        for arrayid in self.job_manager.pending_arrays():
+            self.queue_array_submission(arrayid)
+
+
+    def queue_submission(self, jobid):
+        future = self.submitter.submit(self.job_manager.submit_pending_job, jobid)
+        future.add_done_callback(self.submission_done)
+
+
+    def queue_array_submission(self, arrayid):
+        future = self.submitter.submit(self.job_manager.submit_pending_array, arrayid)
+        future.add_done_callback(self.submission_done)
+
+
+    def submission_done(self, future):
+        if (future.exception() is not None):
+           logging.error("Job submission failed: %s" % str(future.exception()))
+
+
+    async def reconcile(self):
+        try:
+            loop = tornado.ioloop.IOLoop.current()
+            await loop.run_in_executor(None, self.job_manager.reconcile)
+        except Exception as e:
+            logging.error("Job reconcile failed: %s" % str(e))
+
+
+    async def retire(self):
+        try:
+            loop = tornado.ioloop.IOLoop.current()
+            await loop.run_in_executor(None, self.job_manager.retire_jobs)
+        except Exception as e:
+            logging.error("Job retirement failed: %s" % str(e))
+
+
+    async def compress_outputs(self):
+        try:
+            loop = tornado.ioloop.IOLoop.current()
+            compressed = await loop.run_in_executor(None, self.job_manager.compress_job_outputs)
+            if (compressed > 0):
+               logging.info("Compressed %d job output files" % compressed)
+        except Exception as e:
+            logging.error("Output compression failed: %s" % str(e))
+
+
+    async def collect_workdirs(self):
+        try:
+            loop = tornado.ioloop.IOLoop.current()
+            reclaimed = await loop.run_in_executor(None, self.workdir_gc.collect)
+            if (reclaimed > 0):
+               logging.info("Reclaimed %d job workdirs" % reclaimed)
+        except Exception as e:
+            logging.error("Workdir GC failed: %s" % str(e))
+
 
 
 
@@ -340,7 +1115,8 @@ if __name__ == "__main__":
    logging.info("Loading certificate files: '{0}', '{1}' ".format(cert, key))
    ssl_context.load_cert_chain(cert, key)
 
-   server = tornado.httpserver.HTTPServer(ComputeServer(config), 
+   app = ComputeServer(config)
+   server = tornado.httpserver.HTTPServer(app, 
 #      ssl_options = ssl_context
    )
 
@@ -348,4 +1124,6 @@ if __name__ == "__main__":
    server.listen(port)
    logging.info("QCloud server running on port %s" % port)
 
+   app.start()
+
    tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import urllib.parse
+
+import tornado.testing
+import tornado.web
+
+import web_server
+from job_manager import JobManager, ComputationalJob
+from token_cache import TokenCache
+
+
+class FakeJobManager(JobManager):
+    """Keeps the owner of each job in memory, with the job files in a
+    temporary workdir"""
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.owners = { }
+        self.deleted = []
+
+    def add_job(self, jobid, userid, files):
+        self.owners[jobid] = userid
+        os.makedirs(self.get_job_workdir(jobid))
+        for (fname, data) in files.items():
+            with open(os.path.join(self.get_job_workdir(jobid), fname), "w") as fh:
+               fh.write(data)
+
+    def get_job(self, jobid, userid = None):
+        if (jobid not in self.owners or (userid is not None and self.owners[jobid] != userid)):
+           return ComputationalJob(jobid, -1, "DNE", [])
+        return ComputationalJob(jobid, "42", "RUNNING", os.listdir(self.get_job_workdir(jobid)))
+
+    def get_jobs(self, jobids, userid = None):
+        return [self.get_job(jobid, userid) for jobid in jobids]
+
+    def get_job_workdir(self, jobid):
+        return os.path.join(self.workdir, jobid)
+
+    def get_job_info(self, job):
+        return "JobId=42 JobName=secret"
+
+    def delete_job(self, jobid, userid = None):
+        self.deleted.append((jobid, userid))
+
+
+
+class FakeJobWatcher():
+    def __init__(self):
+        self.watched = []
+
+    def watch(self, jobid, queue):
+        self.watched.append(jobid)
+
+    def unwatch(self, jobid, queue):
+        pass
+
+
+
+class FakeRevocations():
+    def is_revoked(self, jti):
+        return False
+
+
+
+class FakeUserActivity():
+    def touch(self, userid):
+        pass
+
+
+
+class FakeRateLimiter():
+    def check(self, name, ident, cost = 1):
+        return 0
+
+    def client_address(self, request):
+        return request.remote_ip
+
+
+
+class OwnershipTest(tornado.testing.AsyncHTTPTestCase):
+    """Checks that no endpoint gives one user's job to another"""
+
+    def get_app(self):
+        self.workdir = tempfile.mkdtemp()
+        self.job_manager = FakeJobManager(self.workdir)
+        self.job_manager.add_job("alicejob", "alice", { "output" : "alice's secret output" })
+        self.job_watcher = FakeJobWatcher()
+
+        token_cache = TokenCache(10)
+        token_cache.put("alice-token", "alice", None)
+        token_cache.put("bob-token", "bob", None)
+
+        args = dict(authentication_url = "http://127.0.0.1:1",
+                    authentication_timeout = 1,
+                    token_validation = "local",
+                    token_cache = token_cache,
+                    jwt_keyring = None,
+                    revocations = FakeRevocations(),
+                    rate_limiter = FakeRateLimiter(),
+                    user_activity = FakeUserActivity(),
+                    job_manager = self.job_manager)
+
+        return tornado.web.Application([
+           (r"/download", web_server.Download, dict(args, accel_redirect = None)),
+           (r"/archive",  web_server.Archive,  args),
+           (r"/tail",     web_server.TailFile, dict(args, poll_interval = 0.01)),
+           (r"/delete",   web_server.DeleteJob, args),
+           (r"/status",   web_server.JobStatus, args),
+           (r"/info",     web_server.JobInfo,  args),
+           (r"/list",     web_server.ListFiles, args),
+           (r"/watch",    web_server.WatchJobs, dict(args, job_watcher = self.job_watcher,
+                                                     heartbeat = 0.01)),
+        ])
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.workdir)
+
+    def request(self, path, token, **args):
+        query = urllib.parse.urlencode(dict(args, cookie = token, jobid = "alicejob"))
+        return self.fetch("%s?%s" % (path, query))
+
+    def assertRefused(self, res):
+        self.assertEqual(res.code, 404)
+        self.assertNotEqual(res.headers.get("Qcloud-Server-Status"), "OK")
+        self.assertNotIn(b"secret", res.body)
+
+    def test_owner(self):
+        res = self.request("/download", "alice-token", file = "output")
+        self.assertEqual(res.code, 200)
+        self.assertEqual(res.body, b"alice's secret output")
+
+    def test_download(self):
+        self.assertRefused(self.request("/download", "bob-token", file = "output"))
+
+    def test_archive(self):
+        self.assertRefused(self.request("/archive", "bob-token"))
+
+    def test_tail(self):
+        self.assertRefused(self.request("/tail", "bob-token"))
+
+    def test_delete(self):
+        self.assertRefused(self.request("/delete", "bob-token"))
+        self.assertEqual(self.job_manager.deleted, [])
+        # The job manager checks the owner again as it deletes the job
+        self.request("/delete", "alice-token")
+        self.assertEqual(self.job_manager.deleted, [("alicejob", "alice")])
+
+    def test_status(self):
+        res = self.request("/status", "bob-token")
+        self.assertRefused(res)
+        self.assertIsNone(res.headers.get("Qcloud-Server-Jobstatus"))
+
+    def test_info(self):
+        self.assertRefused(self.request("/info", "bob-token"))
+
+    def test_list(self):
+        self.assertRefused(self.request("/list", "bob-token"))
+
+    def test_watch(self):
+        # Reported once as INVALID, without watching for its changes
+        res = self.request("/watch", "bob-token")
+        events = [json.loads(line[5:]) for line in res.body.decode().splitlines()
+                     if line.startswith("data:")]
+        self.assertEqual(events, [{ "jobid" : "alicejob", "status" : "INVALID" }])
+        self.assertEqual(self.job_watcher.watched, [])
+
+    def test_unknown(self):
+        query = urllib.parse.urlencode({ "cookie" : "alice-token", "jobid" : "nosuchjob" })
+        self.assertEqual(self.fetch("/status?" + query).code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
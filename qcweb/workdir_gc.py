@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import configparser
+
+from job_store import final_states
+from workdir_layout import job_path
+
+
+def disk_usage(path):
+    """Returns the bytes and inodes used by a directory tree"""
+    (size, inodes) = (0, 1)
+    dirs = [path]
+    while (dirs):
+        for entry in os.scandir(dirs.pop()):
+            inodes += 1
+            if (entry.is_dir(follow_symlinks=False)):
+               dirs.append(entry.path)
+            else:
+               size += entry.stat(follow_symlinks=False).st_size
+    return (size, inodes)
+
+
+
+class WorkdirGC():
+    """Reclaims the workdirs of jobs that finished more than the configured
+    age ago for their final state.  Workdirs are either deleted or moved to
+    tier_dir, and the space is credited back to the job owner's usage.  The
+    workdir of a job array goes the same way once those of all its tasks
+    have.  Totals are kept in the gc:stats hash."""
+
+    def __init__(self, job_manager, config):
+        self.job_manager = job_manager
+        self.db = job_manager.db
+
+        self.ages = { }
+        for status in final_states:
+            self.ages[status] = config.getint("gc", "%s_age" % status.lower(), fallback=0)
+
+        self.action = config.get("gc", "action", fallback="delete")
+        self.tier_dir = config.get("gc", "tier_dir", fallback=None)
+        if (self.action not in ("delete", "tier")):
+           raise Exception("Invalid GC action " + self.action)
+        if (self.action == "tier" and not self.tier_dir):
+           raise Exception("GC action tier needs a tier_dir")
+
+
+    def collect(self, batch = 500):
+        """Reclaims every workdir that is due, returns the number reclaimed"""
+        start = time.time()
+        reclaimed = 0
+        for (status, age) in self.ages.items():
+            if (age <= 0):
+               continue
+
+            failed = 0
+            while True:
+                jobids = self.db.zrangebyscore("jobs:finished:%s" % status,
+                   "-inf", start - age, start=failed, num=batch)
+                if (not jobids):
+                   break
+
+                docs = self.job_manager.store.get_many(jobids)
+                for (jobid, doc) in zip(jobids, docs):
+                    try:
+                        self.reclaim(jobid, doc, status)
+                        reclaimed += 1
+                    except Exception as e:
+                        # Left for the next pass
+                        logging.error("GC of workdir failed; JID=%s: %s" % (jobid, str(e)))
+                        failed += 1
+
+                if (len(jobids) < batch):
+                   break
+
+        for arrayid in self.db.smembers("arrays:reclaim"):
+            try:
+                self.reclaim_array(arrayid)
+            except Exception as e:
+                logging.error("GC of array workdir failed; AID=%s: %s" % (arrayid, str(e)))
+
+        with self.db.pipeline() as p:
+            p.hset("gc:stats", "last_run", start)
+            p.hset("gc:stats", "last_duration", time.time() - start)
+            p.execute()
+        return reclaimed
+
+
+    def reclaim(self, jobid, doc, status):
+        # Records retired without an archive leave what is needed here
+        if (doc is None):
+           doc = self.db.hgetall("retired:%s" % jobid) or None
+
+        workdir = self.job_manager.get_job_workdir(jobid)
+        (size, inodes) = (0, 0)
+        if (os.path.isdir(workdir) and not os.path.islink(workdir) and
+           (self.tier_dir is None or not workdir.startswith(self.tier_dir))):
+           (size, inodes) = disk_usage(workdir)
+           if (self.action == "tier"):
+              target = job_path(self.tier_dir, jobid, self.job_manager.layout)
+              os.makedirs(os.path.dirname(target), exist_ok=True)
+              shutil.move(workdir, target)
+           else:
+              shutil.rmtree(workdir)
+
+        # Left behind when the workdir was moved by migrate_workdirs.py
+        link = os.path.join(self.job_manager.workdir, jobid)
+        if (os.path.islink(link)):
+           os.unlink(link)
+
+        # Arrays written before their tasks were counted are left alone
+        arrayid = doc.get("array") if doc is not None else None
+        if (arrayid is not None and not self.db.hexists("arrays:tasks", arrayid)):
+           arrayid = None
+
+        with self.db.pipeline(transaction=False) as p:
+            p.zrem("jobs:finished:%s" % status, jobid)
+            p.delete("retired:%s" % jobid)
+            if (doc is not None and doc.get("userid")):
+               self.job_manager.add_usage(p, doc["userid"],
+                  -int(doc.get("bytes", 0)), -int(doc.get("inodes", 0)))
+            if (size > 0 or inodes > 0):
+               p.hincrby("gc:stats", "reclaimed_bytes", size)
+               p.hincrby("gc:stats", "reclaimed_inodes", inodes)
+               p.hincrby("gc:stats", "workdirs_%s" % ("tiered" if self.action == "tier" else "deleted"), 1)
+            if (arrayid is not None):
+               p.hincrby("arrays:tasks", arrayid, -1)
+            remaining = p.execute()[-1]
+
+        if (arrayid is not None and remaining <= 0):
+           self.db.sadd("arrays:reclaim", arrayid)
+
+        if (self.action == "delete"):
+           self.job_manager.store.update(jobid, { "files" : [], "workdir" : "deleted" })
+        else:
+           self.job_manager.store.update(jobid, { "workdir" : "tiered" })
+        logging.debug("GC %s workdir; JID=%s  bytes=%d  inodes=%d" %
+           (self.action, jobid, size, inodes))
+
+
+
+    def reclaim_array(self, arrayid):
+        arraydir = self.job_manager.get_array_workdir(arrayid)
+        if (os.path.isdir(arraydir)):
+           if (self.action == "tier"):
+              target = os.path.join(self.tier_dir, "arrays", arrayid)
+              os.makedirs(os.path.dirname(target), exist_ok=True)
+              shutil.move(arraydir, target)
+           else:
+              shutil.rmtree(arraydir)
+
+        with self.db.pipeline(transaction=False) as p:
+            p.hdel("arrays:tasks", arrayid)
+            p.srem("arrays:reclaim", arrayid)
+            p.hincrby("gc:stats", "arrays_%s" % ("tiered" if self.action == "tier" else "deleted"), 1)
+            p.execute()
+        logging.debug("GC %s array workdir; AID=%s" % (self.action, arrayid))
+
+
+
+if __name__ == "__main__":
+   # Runs a single collection, for use from cron when the periodic
+   # collection in qcweb is disabled.
+   from job_manager import JobManager
+
+   logging.basicConfig(level=logging.INFO,
+      format='%(asctime)s - %(levelname)-8s - %(message)s',
+      datefmt='%d/%m/%Y %Hh%Mm%Ss')
+
+   config = configparser.ConfigParser()
+   config.read(sys.argv[1])
+
+   job_manager = JobManager(config)
+   reclaimed = WorkdirGC(job_manager, config).collect()
+   job_manager.close_connection()
+   logging.info("Reclaimed %d workdirs" % reclaimed)